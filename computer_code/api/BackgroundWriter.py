@@ -0,0 +1,109 @@
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from abc import ABC, abstractmethod
+
+# Queued by `close` to stop the writer thread
+_STOP = object()
+
+
+class BackgroundWriter(ABC):
+    """
+    Base of the recorders that write capture data to a directory on a
+    separate thread. `_put` never blocks, items are dropped (and counted in
+    `dropped_frames`) once `queue_size` are waiting so a slow disk never
+    holds back capture.
+
+    Subclasses set up their state before calling `__init__`, which starts
+    the writer thread. The thread calls `_open` first, `_write` for each item
+    and `_close` once closed. With a `tick_interval` it also calls `_tick`
+    every that many seconds, whether or not items arrive. If the writer
+    raises, it stops there, `error` holds the exception and later items are
+    dropped.
+
+    """
+
+    def __init__(self, path, queue_size, tick_interval=None):
+        self.path = path
+        self.tick_interval = tick_interval
+        self.dropped_frames = 0
+        self.error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+
+        os.makedirs(path, exist_ok=True)
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        # Returns the exception that stopped the writer, if any. A dead writer
+        # never empties the queue, so don't wait on it for room
+        while self._thread.is_alive():
+            try:
+                self._queue.put(_STOP, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self._thread.join()
+        return self.error
+
+    def _put(self, item):
+        # Returns False if the item was dropped
+        if self.error is not None:
+            self.dropped_frames += 1
+            return False
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped_frames += 1
+            return False
+        return True
+
+    def _write_loop(self):
+        try:
+            self._write_items()
+        except Exception as e:
+            traceback.print_exc()
+            self.error = e
+
+    def _write_items(self):
+        self._open()
+        next_tick = None if self.tick_interval is None else time.monotonic() + self.tick_interval
+        while True:
+            try:
+                timeout = None if next_tick is None else max(next_tick - time.monotonic(), 0)
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                break
+            if item is not None:
+                self._write(item)
+            if next_tick is not None and time.monotonic() >= next_tick:
+                self._tick()
+                next_tick = time.monotonic() + self.tick_interval
+
+        self._close()
+
+    def _open(self):
+        pass
+
+    @abstractmethod
+    def _write(self, item):
+        pass
+
+    def _tick(self):
+        pass
+
+    def _close(self):
+        pass
+
+
+# Replaces the JSON file at `path` in one step, readers never see it half written
+def write_json(path, data):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(f"{path}.tmp", path)
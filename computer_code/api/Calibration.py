@@ -0,0 +1,73 @@
+import numpy as np
+from settings import intrinsic_matrices as default_intrinsic_matrices
+
+
+class Calibration:
+    """
+    Everything the triangulation path derives from a set of camera poses,
+    computed once when the poses change instead of per point per frame.
+
+    `projection_matrices[i]` is camera i's 3x4 projection matrix.
+    `fundamental_matrices[i, j]` maps a point in camera i to its epipolar line
+    in camera j (`l_j = F[i, j] @ x_i`), `epipoles[i, j]` is camera i's centre
+    as seen by camera j.
+
+    """
+
+    def __init__(self, camera_poses, intrinsic_matrices=None):
+        if intrinsic_matrices is None:
+            intrinsic_matrices = default_intrinsic_matrices
+
+        self.camera_poses = [
+            {
+                "R": np.array(camera_pose["R"], dtype=np.float64).reshape((3, 3)),
+                "t": np.array(camera_pose["t"], dtype=np.float64).reshape((3, 1)),
+            }
+            for camera_pose in camera_poses
+        ]
+        self.num_cameras = len(self.camera_poses)
+        self.intrinsic_matrices = np.array(intrinsic_matrices[: self.num_cameras], dtype=np.float64)
+
+        self.projection_matrices = np.array(
+            [
+                intrinsic_matrix @ np.c_[camera_pose["R"], camera_pose["t"]]
+                for intrinsic_matrix, camera_pose in zip(self.intrinsic_matrices, self.camera_poses)
+            ]
+        )
+        self.camera_centers = np.array(
+            [(-camera_pose["R"].T @ camera_pose["t"])[:, 0] for camera_pose in self.camera_poses]
+        )
+
+        # epipoles[i, j] = P_j @ C_i
+        homogeneous_centers = np.c_[self.camera_centers, np.ones(self.num_cameras)]
+        self.epipoles = np.einsum("jab,ib->ija", self.projection_matrices, homogeneous_centers)
+
+        # F[i, j] = [e_ij]_x @ P_j @ pinv(P_i)
+        pseudo_inverses = np.linalg.pinv(self.projection_matrices)
+        self.fundamental_matrices = np.zeros((self.num_cameras, self.num_cameras, 3, 3))
+        for i in range(0, self.num_cameras):
+            for j in range(0, self.num_cameras):
+                if i == j:
+                    continue
+                F = skew(self.epipoles[i, j]) @ self.projection_matrices[j] @ pseudo_inverses[i]
+                self.fundamental_matrices[i, j] = F / np.linalg.norm(F)
+
+    def epipolar_lines(self, points, from_camera, to_camera):
+        """
+        Epipolar lines in `to_camera` for (N, 2) `points` in `from_camera`, as
+        (N, 3) `[a, b, c]` rows normalised so that `a**2 + b**2 == 1`.
+
+        """
+        points = np.reshape(np.asarray(points, dtype=np.float64), (-1, 2))
+        lines = np.c_[points, np.ones(len(points))] @ self.fundamental_matrices[from_camera, to_camera].T
+        return lines / np.linalg.norm(lines[:, :2], axis=1, keepdims=True)
+
+
+def skew(v):
+    return np.array(
+        [
+            [0, -v[2], v[1]],
+            [v[2], 0, -v[0]],
+            [-v[1], v[0], 0],
+        ]
+    )
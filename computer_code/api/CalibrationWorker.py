@@ -0,0 +1,119 @@
+import multiprocessing
+import queue
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2 as cv
+import numpy as np
+
+from helpers import initial_camera_poses, sparse_bundle_adjustment
+
+
+class CalibrationCancelled(Exception):
+    pass
+
+
+class CalibrationNotConverged(Exception):
+    pass
+
+
+class CalibrationWorker:
+    """
+    Runs camera pose solves in a separate process so they neither block the
+    socket handlers nor compete with the capture loop for the GIL. One solve
+    runs at a time, progress is reported back through a manager queue and a
+    solve can be cancelled between solver iterations.
+
+    """
+
+    def __init__(self):
+        # spawn rather than fork, the capture thread and camera handles must
+        # not be copied into the child
+        self._context = multiprocessing.get_context("spawn")
+        self._executor = None
+        self._manager = None
+        self._progress = None
+        self._cancel = None
+        self._future = None
+
+    def start(self, image_points, camera_poses=None):
+        """
+        Starts solving for the camera poses, from an essential matrix estimate
+        when `camera_poses` is None. Returns False if a solve is already
+        running.
+
+        """
+        if self.is_running():
+            return False
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=1, mp_context=self._context, initializer=_init_worker
+            )
+            self._manager = self._context.Manager()
+            self._progress = self._manager.Queue()
+            self._cancel = self._manager.Event()
+
+        self._cancel.clear()
+        self.poll()
+        self._future = self._executor.submit(
+            solve_camera_poses, image_points, camera_poses, self._progress, self._cancel
+        )
+        return True
+
+    def cancel(self):
+        if self.is_running():
+            self._cancel.set()
+
+    def is_running(self):
+        return self._future is not None and not self._future.done()
+
+    def poll(self):
+        updates = []
+        while True:
+            try:
+                updates.append(self._progress.get_nowait())
+            except queue.Empty:
+                return updates
+
+    def result(self):
+        """
+        `(camera_poses, camera_errors)` of the last solve, raises
+        CalibrationCancelled if it was cancelled, CalibrationNotConverged if it
+        ran out of evaluations or whatever the solve raised.
+
+        """
+        return self._future.result()
+
+    def shutdown(self):
+        if self._executor is None:
+            return
+        self.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._manager.shutdown()
+        self._executor = None
+        self._manager = None
+
+
+def _init_worker():
+    # Leave the cores to the capture loop
+    cv.setNumThreads(1)
+
+
+def solve_camera_poses(image_points, camera_poses, progress, cancel):
+    image_points = np.array(image_points)
+    if camera_poses is None:
+        camera_poses = initial_camera_poses(image_points)
+
+    def callback(iteration, cost, mean_error):
+        if cancel.is_set():
+            raise CalibrationCancelled()
+        progress.put({"iteration": iteration, "cost": cost, "error": mean_error})
+
+    camera_poses, _, camera_errors, solve = sparse_bundle_adjustment(
+        image_points, camera_poses, callback=callback
+    )
+    if not solve["converged"]:
+        raise CalibrationNotConverged(
+            f"no convergence after {solve['evaluations']} evaluations, try better starting poses"
+        )
+    return camera_poses, camera_errors
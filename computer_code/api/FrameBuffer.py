@@ -0,0 +1,68 @@
+import threading
+
+
+class FrameBuffer:
+    """
+    Latest-frame broadcast buffer shared between the capture thread and any
+    number of consumers (MJPEG streams, etc).
+
+    The producer publishes every processed frame set, subscribers block until a
+    newer one is available. Slow subscribers skip frames instead of queueing
+    them, so they can never hold back the capture loop.
+
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._frames = None
+        self._sequence = 0
+        self._subscribers = 0
+
+    def publish(self, frames):
+        with self._condition:
+            self._frames = frames
+            self._sequence += 1
+            self._condition.notify_all()
+
+    def subscribe(self):
+        with self._condition:
+            self._subscribers += 1
+        return Subscription(self)
+
+    def subscriber_count(self):
+        return self._subscribers
+
+    def _unsubscribe(self):
+        with self._condition:
+            self._subscribers -= 1
+
+    def _wait(self, last_sequence, timeout):
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._sequence != last_sequence, timeout=timeout
+            )
+            return self._sequence, self._frames
+
+
+class Subscription:
+    def __init__(self, frame_buffer):
+        self._frame_buffer = frame_buffer
+        self._sequence = 0
+        self.closed = False
+
+    def next(self, timeout=None):
+        """
+        Blocks until a frame set newer than the last one returned is published.
+        Returns `(sequence, frames)`, or `(sequence, None)` if `timeout` expired.
+
+        """
+        sequence, frames = self._frame_buffer._wait(self._sequence, timeout)
+        if sequence == self._sequence:
+            return sequence, None
+        self._sequence = sequence
+        return sequence, frames
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._frame_buffer._unsubscribe()
@@ -0,0 +1,95 @@
+import os
+import numpy as np
+from BackgroundWriter import BackgroundWriter, write_json
+
+MANIFEST = "manifest.json"
+VERSION = 1
+# Frame sets waiting to be written
+WRITE_QUEUE_SIZE = 64
+
+
+class FrameRecorder(BackgroundWriter):
+    """
+    Records raw frame sets, as returned by `read(squeeze=False)`, to a
+    directory of fixed-size chunks. Each chunk is an `.npy` file of shape
+    (chunk_size, cameras, height, width, channels) written through a memory
+    map, with its timestamps in a matching `_timestamps.npy`. `manifest.json`
+    lists the completed chunks and is rewritten after each one, so a
+    recording cut short is readable up to its last full chunk.
+
+    Frames are copied on `write` and written to disk on a separate thread,
+    see `BackgroundWriter`.
+
+    """
+
+    def __init__(self, path, chunk_size=256):
+        self.chunk_size = chunk_size
+        self.num_frames = 0
+        self._manifest = None
+        self._chunk = None
+        self._chunk_timestamps = None
+        self._chunk_frames = 0
+        super().__init__(path, WRITE_QUEUE_SIZE)
+
+    def write(self, frames, timestamps):
+        # Returns False if the frame set was dropped, frames aren't copied once
+        # the writer has stopped
+        if self.error is not None:
+            self.dropped_frames += 1
+            return False
+        return self._put((np.stack(frames), np.array(timestamps, dtype=np.float64)))
+
+    def _write(self, item):
+        frames, timestamps = item
+        if self._manifest is None:
+            self._start_recording(frames, timestamps)
+        if self._chunk is None:
+            self._open_chunk()
+        self._chunk[self._chunk_frames] = frames
+        self._chunk_timestamps[self._chunk_frames] = timestamps
+        self._chunk_frames += 1
+        self.num_frames += 1
+        if self._chunk_frames == self.chunk_size:
+            self._close_chunk()
+
+    def _close(self):
+        if self._chunk is not None:
+            self._close_chunk()
+
+    def _start_recording(self, frames, timestamps):
+        self._manifest = {
+            "version": VERSION,
+            "num_cameras": frames.shape[0],
+            "frame_shape": list(frames.shape[1:]),
+            "dtype": str(frames.dtype),
+            "chunk_size": self.chunk_size,
+            "num_frames": 0,
+            "chunks": [],
+        }
+
+    def _open_chunk(self):
+        chunk_index = len(self._manifest["chunks"])
+        self._chunk_name = f"chunk_{chunk_index:05d}"
+        self._chunk = np.lib.format.open_memmap(
+            os.path.join(self.path, f"{self._chunk_name}.npy"),
+            mode="w+",
+            dtype=self._manifest["dtype"],
+            shape=(self.chunk_size, self._manifest["num_cameras"], *self._manifest["frame_shape"]),
+        )
+        self._chunk_timestamps = np.zeros((self.chunk_size, self._manifest["num_cameras"]))
+        self._chunk_frames = 0
+
+    def _close_chunk(self):
+        self._chunk.flush()
+        np.save(os.path.join(self.path, f"{self._chunk_name}_timestamps.npy"), self._chunk_timestamps)
+        self._manifest["chunks"].append(
+            {
+                "frames": f"{self._chunk_name}.npy",
+                "timestamps": f"{self._chunk_name}_timestamps.npy",
+                "num_frames": self._chunk_frames,
+            }
+        )
+        self._manifest["num_frames"] += self._chunk_frames
+        self._chunk = None
+        self._chunk_timestamps = None
+        write_json(os.path.join(self.path, MANIFEST), self._manifest)
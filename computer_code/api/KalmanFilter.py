@@ -1,132 +1,293 @@
-import cv2 as cv
 import numpy as np
+from scipy.optimize import linear_sum_assignment
 from LowPassFilter import LowPassFilter
 import time
 
 
 class KalmanFilter:
-    def __init__(self, num_objects):
+    """
+    Constant acceleration Kalman filter for every tracked object at once.
+    States `[x, y, z, vx, vy, vz, ax, ay, az]` and their covariances are kept
+    in (N, 9) and (N, 9, 9) arrays, and prediction and correction run for all
+    objects in one vectorized step. Detections are assigned to tracks by
+    minimum total distance to the predicted positions, and detections further
+    than `gate_distance` from a track are never assigned to it.
+
+    Tracks are managed automatically in `num_objects` fixed slots. A detection
+    no track claims starts a new track in a free slot, a track that misses a
+    detection coasts on its prediction (its covariance growing every frame)
+    and is dropped after `max_missed_frames` consecutive misses. A track is
+    reported once it has been matched `min_hits` times, with its slot as its
+    droneIndex.
+
+    A detection's droneIndex is the rigid body it matched, kept as the label
+    of the track it starts and reported as its "body". Detections are only
+    assigned to tracks with the same label, so copies of one body each get
+    their own track. New tracks take the slot numbered like their label when
+    it's free, so a lone copy of each body keeps its index as droneIndex.
+
+    Detections carrying an orientation quaternion (x, y, z, w) have it
+    low-pass filtered per track, component-wise after flipping each
+    quaternion into the same hemisphere as the track's last orientation. A
+    track matched to a detection without one has no orientation.
+
+    """
+
+    def __init__(self, num_objects, gate_distance=0.5, max_missed_frames=30, min_hits=1):
         state_dim = 9
         measurement_dim = 6
-        dt = 0.1
-        self.kalmans = []
+        self.num_objects = num_objects
+        self.gate_distance = gate_distance
+        self.max_missed_frames = max_missed_frames
+        self.min_hits = min_hits
         self.prev_measurement_time = 0
-        self.prev_positions = []
 
-        self.low_pass_filter_xy = []
-        self.low_pass_filter_z = []
-        self.heading_low_pass_filter = []
-        self.num_objects = num_objects
+        self.states = np.zeros((num_objects, state_dim))
+        self.covariances = np.zeros((num_objects, state_dim, state_dim))
+        self.initialized = np.zeros(num_objects, dtype=bool)
+        self.prev_positions = np.zeros((num_objects, 3))
+        self.prev_position_times = np.zeros(num_objects)
+        self.hits = np.zeros(num_objects, dtype=int)
+        # Rigid body of each track, -1 if its detections had none
+        self.labels = np.full(num_objects, -1)
+        self.orientations = np.zeros((num_objects, 4))
+        self.has_orientation = np.zeros(num_objects, dtype=bool)
+        self.missed_frames = np.zeros(num_objects, dtype=int)
+
+        self.process_noise_cov = np.eye(state_dim) * 1e-2
+        self.measurement_noise_cov = np.eye(measurement_dim) * 1e0
+        # The measurement is position and velocity, the first six state entries
+        self.measurement_dim = measurement_dim
 
-        for i in range(num_objects):
-            self.prev_positions.append([0, 0, 0])
-            self.kalmans.append(cv.KalmanFilter(state_dim, measurement_dim))
-            self.kalmans[i].transitionMatrix = np.array(
-                [
-                    [1, 0, 0, dt, 0, 0, 0.5 * dt**2, 0, 0],
-                    [0, 1, 0, 0, dt, 0, 0, 0.5 * dt**2, 0],
-                    [0, 0, 1, 0, 0, dt, 0, 0, 0.5 * dt**2],
-                    [0, 0, 0, 1, 0, 0, dt, 0, 0],
-                    [0, 0, 0, 0, 1, 0, 0, dt, 0],
-                    [0, 0, 0, 0, 0, 1, 0, 0, dt],
-                    [0, 0, 0, 0, 0, 0, 1, 0, 0],
-                    [0, 0, 0, 0, 0, 0, 0, 1, 0],
-                    [0, 0, 0, 0, 0, 0, 0, 0, 1],
-                ],
-                dtype=np.float32,
-            )
-
-            self.kalmans[i].processNoiseCov = np.eye(state_dim, dtype=np.float32) * 1e-2
-            self.kalmans[i].measurementNoiseCov = (
-                np.eye(measurement_dim, dtype=np.float32) * 1e0
-            )
-            self.kalmans[i].measurementMatrix = np.array(
-                [
-                    [1, 0, 0, 0, 0, 0, 0, 0, 0],
-                    [0, 1, 0, 0, 0, 0, 0, 0, 0],
-                    [0, 0, 1, 0, 0, 0, 0, 0, 0],
-                    [0, 0, 0, 1, 0, 0, 0, 0, 0],
-                    [0, 0, 0, 0, 1, 0, 0, 0, 0],
-                    [0, 0, 0, 0, 0, 1, 0, 0, 0],
-                ],
-                dtype=np.float32,
-            )
-
-            self.kalmans[i].statePost = np.zeros((9, 1), dtype=np.float32)
-
-            self.low_pass_filter_xy.append(
-                LowPassFilter(cutoff_frequency=20, sampling_frequency=60.0, dims=2)
-            )
-            self.low_pass_filter_z.append(
-                LowPassFilter(cutoff_frequency=20, sampling_frequency=60.0, dims=1)
-            )
-            self.heading_low_pass_filter.append(
-                LowPassFilter(cutoff_frequency=20, sampling_frequency=60.0, dims=1)
-            )
+        self.velocity_low_pass_filter = LowPassFilter(
+            cutoff_frequency=20, sampling_frequency=60.0, dims=(num_objects, 3)
+        )
+        self.heading_low_pass_filter = LowPassFilter(
+            cutoff_frequency=20, sampling_frequency=60.0, dims=(num_objects,)
+        )
+        self.orientation_low_pass_filter = LowPassFilter(
+            cutoff_frequency=20, sampling_frequency=60.0, dims=(num_objects, 4)
+        )
+
+    def transition_matrix(self, dt):
+        transition_matrix = np.eye(9)
+        transition_matrix[:3, 3:6] = dt * np.eye(3)
+        transition_matrix[3:6, 6:9] = dt * np.eye(3)
+        transition_matrix[:3, 6:9] = 0.5 * dt**2 * np.eye(3)
+        return transition_matrix
+
+    def predict(self, tracks, dt):
+        transition_matrix = self.transition_matrix(dt)
+        states = self.states[tracks] @ transition_matrix.T
+        covariances = (
+            transition_matrix @ self.covariances[tracks] @ transition_matrix.T
+            + self.process_noise_cov
+        )
+        return states, covariances
+
+    def correct(self, states, covariances, measurements):
+        m = self.measurement_dim
+        innovation_covs = covariances[:, :m, :m] + self.measurement_noise_cov
+        gains = np.linalg.solve(innovation_covs, covariances[:, :m, :]).transpose((0, 2, 1))
+        innovations = measurements - states[:, :m]
+        states = states + np.einsum("nij,nj->ni", gains, innovations)
+        covariances = covariances - gains @ covariances[:, :m, :]
+        return states, covariances
+
+    def assign(self, predicted_positions, tracks, positions, drone_indicies):
+        """
+        Matches detections to tracks, returns `(track_indicies,
+        detection_indicies)`. A detection carrying a droneIndex can only be
+        matched to a track with that label.
+
+        """
+        if len(tracks) == 0 or len(positions) == 0:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+        distances = np.linalg.norm(
+            predicted_positions[:, np.newaxis, :] - positions[np.newaxis, :, :], axis=2
+        )
+        allowed = distances <= self.gate_distance
+        has_index = drone_indicies >= 0
+        allowed &= ~has_index | (self.labels[tracks][:, np.newaxis] == drone_indicies[np.newaxis, :])
+
+        cost = np.where(allowed, distances, self.gate_distance * 1e3)
+        track_indicies, detection_indicies = linear_sum_assignment(cost)
+        valid = allowed[track_indicies, detection_indicies]
+        return tracks[track_indicies[valid]], detection_indicies[valid]
 
     def predict_location(self, objects):
         res = []
 
-        dt = time.time() - self.prev_measurement_time
-        self.prev_measurement_time = time.time()
+        now = time.time()
+        dt = now - self.prev_measurement_time
+        self.prev_measurement_time = now
 
-        for drone_index in range(0, self.num_objects):
-            possible_new_objects = [
-                object for object in objects if object["droneIndex"] == drone_index
-            ]
-            possible_new_positions = [x["pos"] for x in possible_new_objects]
+        positions = np.array([object["pos"] for object in objects], dtype=np.float64).reshape((-1, 3))
+        headings = np.array([object["heading"] for object in objects], dtype=np.float64)
+        quaternions = np.array(
+            [
+                object["quaternion"] if object.get("quaternion") is not None else [np.nan] * 4
+                for object in objects
+            ],
+            dtype=np.float64,
+        ).reshape((-1, 4))
+        drone_indicies = np.array(
+            [
+                object["droneIndex"] if object.get("droneIndex") is not None else -1
+                for object in objects
+            ],
+            dtype=int,
+        )
 
-            if len(possible_new_objects) == 0:
-                continue
+        # Every live track is predicted forward, matched or not
+        tracks = np.flatnonzero(self.initialized)
+        states, covariances = self.predict(tracks, dt)
+        self.states[tracks] = states
+        self.covariances[tracks] = covariances
+        matched_tracks, matched_detections = self.assign(
+            states[:, :3], tracks, positions, drone_indicies
+        )
 
-            kalman = self.kalmans[drone_index]
-
-            kalman.transitionMatrix[:3, 3:6] = dt * np.eye(3)
-            kalman.transitionMatrix[3:6, 6:9] = dt * np.eye(3)
-            kalman.transitionMatrix[:3, 6:9] = 0.5 * dt**2 * np.eye(3)
-
-            if all(kalman.statePost == 0):  # if not initialized
-                A = kalman.statePost
-                A[0:3] = possible_new_positions[0].reshape((3, 1))
-                kalman.statePost = A
-                kalman.statePre = A
-
-            predicted_location = kalman.predict()[:3].T[0]
-            distances_to_predicted_location = np.sqrt(
-                np.sum((possible_new_positions - predicted_location) ** 2, axis=1)
-            )
-            closest_match_i = np.argmin(distances_to_predicted_location)
-            new_pos = possible_new_positions[closest_match_i].astype(np.float32)
-            new_vel = ((new_pos - self.prev_positions[drone_index]) / dt).astype(
-                np.float32
-            )
-            self.prev_positions[drone_index] = new_pos
-
-            kalman.correct(np.concatenate((new_pos, new_vel)))
-            predicted_state = kalman.statePre[:6].T[0]  # Predicted 3D location
-
-            heading = possible_new_objects[closest_match_i]["heading"]
-            heading = self.heading_low_pass_filter[drone_index].filter(heading)[0]
-            # heading, self.z = signal.lfilter(self.b, 1, [heading], zi=self.z)
-
-            vel = predicted_state[3:6].copy()
-            vel[0:2] = self.low_pass_filter_xy[drone_index].filter(vel[0:2])
-            vel[2] = self.low_pass_filter_z[drone_index].filter(vel[2])[0]
-
-            res.append(
-                {
-                    "pos": predicted_state[:3],
-                    "vel": vel,
-                    "heading": heading,
-                    "droneIndex": drone_index,
-                }
-            )
+        # Tracks without a detection coast, and are dropped once stale
+        missed = np.setdiff1d(tracks, matched_tracks)
+        self.missed_frames[missed] += 1
+        self.drop_tracks(missed[self.missed_frames[missed] > self.max_missed_frames])
+
+        # Remaining detections start new tracks in free slots
+        unmatched = np.ones(len(objects), dtype=bool)
+        unmatched[matched_detections] = False
+        new_tracks, new_detections = self.spawn_tracks(
+            positions, drone_indicies, np.flatnonzero(unmatched), now
+        )
+
+        tracks = np.concatenate([matched_tracks, new_tracks]).astype(int)
+        detections = np.concatenate([matched_detections, new_detections]).astype(int)
+        if len(tracks) == 0:
+            return res
+        order = np.argsort(tracks)
+        tracks = tracks[order]
+        detections = detections[order]
+
+        new_positions = positions[detections]
+        new_velocities = (new_positions - self.prev_positions[tracks]) / (
+            now - self.prev_position_times[tracks]
+        )[:, np.newaxis]
+        self.prev_positions[tracks] = new_positions
+        self.prev_position_times[tracks] = now
+
+        states, covariances = self.correct(
+            self.states[tracks],
+            self.covariances[tracks],
+            np.hstack([new_positions, new_velocities]),
+        )
+        self.states[tracks] = states
+        self.covariances[tracks] = covariances
+        self.hits[tracks] += 1
+        self.missed_frames[tracks] = 0
+
+        filtered_headings = self.heading_low_pass_filter.filter(headings[detections], tracks)
+        filtered_velocities = self.velocity_low_pass_filter.filter(states[:, 3:6], tracks)
+        self.update_orientations(tracks, quaternions[detections])
+
+        for i, track in enumerate(tracks):
+            if self.hits[track] < self.min_hits:
+                continue
+            filtered_object = {
+                "pos": states[i, :3],
+                "vel": filtered_velocities[i].copy(),
+                "heading": float(filtered_headings[i]),
+                "droneIndex": int(track),
+                "body": int(self.labels[track]),
+            }
+            if self.has_orientation[track]:
+                filtered_object["quaternion"] = self.orientations[track].copy()
+            res.append(filtered_object)
 
         return res
 
+    def update_orientations(self, tracks, quaternions):
+        valid = ~np.any(np.isnan(quaternions), axis=1)
+        self.orientations[tracks[~valid]] = 0
+        self.has_orientation[tracks[~valid]] = False
+        self.orientation_low_pass_filter.reset(tracks[~valid])
+        tracks = tracks[valid]
+        quaternions = quaternions[valid]
+        if len(tracks) == 0:
+            return
+
+        # q and -q are the same rotation, keep each track's sign continuous
+        flip = self.has_orientation[tracks] & (
+            np.sum(quaternions * self.orientations[tracks], axis=1) < 0
+        )
+        quaternions[flip] *= -1
+
+        filtered_quaternions = self.orientation_low_pass_filter.filter(quaternions, tracks)
+        self.orientations[tracks] = filtered_quaternions / np.linalg.norm(
+            filtered_quaternions, axis=1, keepdims=True
+        )
+        self.has_orientation[tracks] = True
+
+    def spawn_tracks(self, positions, drone_indicies, detections, now):
+        """
+        Starts tracks for `detections`, in detection order, labelled with
+        their droneIndex. The slot numbered like the label is used when free,
+        otherwise the first free slot. Detections left without a free slot are
+        ignored. Returns `(track_indicies, detection_indicies)`.
+
+        """
+        new_tracks = []
+        new_detections = []
+        free = ~self.initialized
+        # Slots numbered like the labels first, then any free slot
+        unplaced = []
+        for detection_i in detections:
+            label = drone_indicies[detection_i]
+            if 0 <= label < self.num_objects and free[label]:
+                free[label] = False
+                new_tracks.append(label)
+                new_detections.append(detection_i)
+            else:
+                unplaced.append(detection_i)
+        for detection_i, track in zip(unplaced, np.flatnonzero(free)):
+            new_tracks.append(track)
+            new_detections.append(detection_i)
+
+        new_tracks = np.array(new_tracks, dtype=int)
+        new_detections = np.array(new_detections, dtype=int)
+        self.states[new_tracks] = 0
+        self.states[new_tracks, :3] = positions[new_detections]
+        # The first correction sees the track's prior as a prediction with
+        # only process noise, as the old per-object filters did
+        self.covariances[new_tracks] = self.process_noise_cov
+        self.prev_positions[new_tracks] = positions[new_detections]
+        # Any non-zero time gives a zero first velocity measurement
+        self.prev_position_times[new_tracks] = now - 1
+        self.hits[new_tracks] = 0
+        self.missed_frames[new_tracks] = 0
+        self.labels[new_tracks] = drone_indicies[new_detections]
+        self.initialized[new_tracks] = True
+        return new_tracks, new_detections
+
+    def drop_tracks(self, tracks):
+        self.initialized[tracks] = False
+        self.states[tracks] = 0
+        self.covariances[tracks] = 0
+        self.hits[tracks] = 0
+        self.missed_frames[tracks] = 0
+        self.labels[tracks] = -1
+        self.velocity_low_pass_filter.reset(tracks)
+        self.heading_low_pass_filter.reset(tracks)
+        self.orientations[tracks] = 0
+        self.has_orientation[tracks] = False
+        self.orientation_low_pass_filter.reset(tracks)
+
+    def num_tracks(self):
+        return int(np.sum(self.initialized))
+
     def reset(self):
         self.prev_measurement_time = time.time() - 20
 
-        for i, kalman in enumerate(self.kalmans):
-            kalman.statePost = np.zeros((9, 1), dtype=np.float32)
-            self.prev_positions[i] = np.array([0, 0, 0])
+        self.drop_tracks(np.arange(self.num_objects))
+        self.prev_positions[:] = 0
+        self.prev_position_times[:] = 0
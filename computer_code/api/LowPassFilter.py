@@ -1,34 +1,83 @@
 import numpy as np
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, tf2ss
 
 
 class LowPassFilter:
+    """
+    Streaming Butterworth low-pass filter. The filter is run in state-space
+    form with its state kept between calls, so each sample costs two small
+    matrix products into preallocated buffers regardless of how long the
+    filter has been running. Output is the same as `lfilter` over the whole
+    history with zero initial conditions.
 
-    def __init__(
-        self, cutoff_frequency, sampling_frequency, dims, order=5, buffer_size=300
-    ):
+    `dims` may be a shape, e.g. `(num_objects, 3)`, to filter many channels
+    together. `channels` then selects the rows to advance, the rest keep
+    their state.
+
+    `filter` returns a view of an internal buffer, which the next call
+    overwrites. Copy it to keep it.
+
+    """
+
+    def __init__(self, cutoff_frequency, sampling_frequency, dims, order=5):
         self.sampling_frequency = sampling_frequency
         self.cutoff_frequency = cutoff_frequency
         self.order = order
         self.dims = dims
-        self.buffer_size = buffer_size
-        self.buffered_data = np.empty((0, dims))
         self.b, self.a = butter(
             self.order,
             self.cutoff_frequency / (self.sampling_frequency / 2),
             btype="low",
         )
+        A, B, C, D = tf2ss(self.b, self.a)
+        self._transition = np.ascontiguousarray(A.T)
+        self._input = B[:, 0].copy()
+        self._output = C[0].copy()
+        self._feedthrough = D[0, 0]
 
-    def filter(self, data):
-        self.buffered_data = np.vstack((self.buffered_data, data[np.newaxis]))
+        self._state = np.zeros(np.append(dims, len(self._input)).astype(int))
+        # Scratch buffers, the selected channels are the first rows of each
+        self._channel_state = np.empty_like(self._state)
+        self._next_state = np.empty_like(self._state)
+        self._input_term = np.empty_like(self._state)
+        self._data = np.empty(dims)
+        self._scaled_data = np.empty(dims)
+        self._filtered_data = np.empty(dims)
 
-        filtered_data = np.apply_along_axis(
-            lambda x: lfilter(self.b, self.a, x), axis=0, arr=self.buffered_data
-        )
+    def filter(self, data, channels=None):
+        if channels is None:
+            self._data[...] = np.reshape(data, self._data.shape)
+            return self._step(self._state, self._data, len(self._state))
+
+        num_channels = len(channels)
+        state = self._channel_state[:num_channels]
+        np.take(self._state, channels, axis=0, out=state)
+        self._data[:num_channels] = np.reshape(data, self._data[:num_channels].shape)
+        filtered_data = self._step(state, self._data[:num_channels], num_channels)
+        self._state[channels] = state
+        return filtered_data
+
+    def _step(self, state, data, num_channels):
+        # Advances `state` in place, returns the output for `data`
+        filtered_data = self._filtered_data[:num_channels]
+        scaled_data = self._scaled_data[:num_channels]
+        next_state = self._next_state[:num_channels]
+        input_term = self._input_term[:num_channels]
+
+        # y = C z + D x
+        np.matmul(state, self._output, out=filtered_data)
+        np.multiply(data, self._feedthrough, out=scaled_data)
+        filtered_data += scaled_data
+
+        # z = A z + B x
+        np.matmul(state, self._transition, out=next_state)
+        np.multiply(data[..., np.newaxis], self._input, out=input_term)
+        np.add(next_state, input_term, out=state)
 
-        if self.buffered_data.shape[0] >= self.buffer_size:
-            self.buffered_data = self.buffered_data[
-                -self.buffer_size // 2 :
-            ]  # Keep the last half of the buffered data for the next filtering iteration
+        return filtered_data
 
-        return filtered_data[-1]
+    def reset(self, channels=None):
+        if channels is None:
+            self._state[:] = 0
+        else:
+            self._state[channels] = 0
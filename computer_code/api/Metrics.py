@@ -0,0 +1,203 @@
+import bisect
+import math
+import threading
+from abc import ABC, abstractmethod
+
+# Upper bounds of the stage duration buckets in seconds, around the 8 ms
+# frame budget at 125 fps
+DURATION_BUCKETS = [0.0005, 0.001, 0.002, 0.004, 0.006, 0.008, 0.012, 0.016, 0.033, 0.066, 0.125]
+
+
+class Metric(ABC):
+    """
+    Base of the metric types, one value (or set of buckets) per combination
+    of label values. Values are read and written under the registry's lock so
+    a scrape never sees a half updated histogram.
+
+    """
+
+    type = None
+
+    def __init__(self, registry, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = registry.lock
+        self._children = {}
+        if len(self.labelnames) == 0:
+            self._children[()] = self._new_child()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {values}")
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        pass
+
+    @abstractmethod
+    def _samples(self):
+        # (suffix, labels, value) for every sample of the metric
+        pass
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+    def _label_pairs(self, values):
+        return list(zip(self.labelnames, values))
+
+
+class _Value:
+    def __init__(self, lock):
+        self._lock = lock
+        self.value = 0.0
+        self.function = None
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def set_function(self, function):
+        # The value is read from function() on every scrape instead
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _Value(self._lock)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def _samples(self):
+        return [("", self._label_pairs(values), child.get()) for values, child in self._children.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class _Buckets:
+    def __init__(self, lock, buckets):
+        self._lock = lock
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, registry, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        self.buckets = sorted(buckets)
+        super().__init__(registry, name, help, labelnames)
+
+    def _new_child(self):
+        return _Buckets(self._lock, self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self):
+        samples = []
+        for values, child in self._children.items():
+            labels = self._label_pairs(values)
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + [math.inf], child.counts):
+                cumulative += count
+                samples.append(("_bucket", labels + [("le", upper_bound)], cumulative))
+            samples.append(("_sum", labels, child.sum))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms rendered together in the Prometheus text
+    exposition format.
+
+    """
+
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self._metrics = {}
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(self, f"{self.prefix}{name}_total", help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._register(Gauge(self, self.prefix + name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        return self._register(Histogram(self, self.prefix + name, help, labelnames, buckets))
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        with self.lock:
+            # Functions given to set_function run under the lock, so they
+            # mustn't update metrics themselves
+            for metric in self._metrics.values():
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    pairs = [f'{name}="{_escape(_format_value(value))}"' for name, value in labels]
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if isinstance(value, str):
+        return value
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,85 @@
+import json
+import os
+import time
+import numpy as np
+from FrameRecorder import MANIFEST, VERSION
+
+
+class ReplayCamera:
+    """
+    Camera source reading a FrameRecorder recording, usable by `Cameras` in
+    place of `pseyepy.Camera`. Chunks are memory mapped, so frames are read
+    straight from the page cache without decoding.
+
+    `speed` scales the recorded frame timing, 2 plays twice as fast, None
+    plays as fast as frames are read. With `loop` the recording restarts
+    when it ends, otherwise `read` raises EOFError.
+
+    """
+
+    def __init__(self, path, speed=1.0, loop=True):
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest["version"] != VERSION:
+            raise ValueError(f"Unsupported recording version {manifest['version']}")
+        if manifest["num_frames"] == 0:
+            raise ValueError(f"Recording {path} has no frames")
+
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.num_cameras = manifest["num_cameras"]
+        self.num_frames = manifest["num_frames"]
+        # Accepted and ignored, as on a live camera they are hardware settings
+        self.exposure = [0] * self.num_cameras
+        self.gain = [0] * self.num_cameras
+
+        self._chunks = []
+        for chunk in manifest["chunks"]:
+            frames = np.load(os.path.join(path, chunk["frames"]), mmap_mode="r")
+            timestamps = np.load(os.path.join(path, chunk["timestamps"]))
+            self._chunks.append((frames[: chunk["num_frames"]], timestamps[: chunk["num_frames"]]))
+
+        self._chunk_index = 0
+        self._frame_index = 0
+        self._first_timestamp = None
+        self._start_time = None
+
+    def read(self, squeeze=False):
+        if self._chunk_index == len(self._chunks):
+            if not self.loop:
+                raise EOFError("End of recording")
+            self._chunk_index = 0
+            self._frame_index = 0
+            self._first_timestamp = None
+
+        frames, timestamps = self._chunks[self._chunk_index]
+        frame_set = frames[self._frame_index]
+        frame_timestamps = timestamps[self._frame_index]
+        self._frame_index += 1
+        if self._frame_index == len(frames):
+            self._chunk_index += 1
+            self._frame_index = 0
+
+        self._wait_for(np.mean(frame_timestamps))
+
+        # Copies, the pipeline draws onto the frames it is given
+        frame_list = [np.array(frame) for frame in frame_set]
+        if squeeze and self.num_cameras == 1:
+            return frame_list[0], frame_timestamps[0]
+        return frame_list, frame_timestamps.tolist()
+
+    def _wait_for(self, timestamp):
+        if self.speed is None:
+            return
+        now = time.perf_counter()
+        if self._first_timestamp is None:
+            self._first_timestamp = timestamp
+            self._start_time = now
+            return
+        delay = self._start_time + (timestamp - self._first_timestamp) / self.speed - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def end(self):
+        self._chunks = []
@@ -0,0 +1,136 @@
+import numpy as np
+from settings import rigid_bodies as default_rigid_bodies
+
+# Upper bound on partial marker assignments kept while matching one body,
+# keeps the search bounded when many markers are at similar distances
+MAX_PARTIAL_MATCHES = 4096
+
+
+class RigidBody:
+    """
+    A constellation of markers fixed to one object. `markers` are the marker
+    positions in the object's own frame, recentred on their centroid so the
+    object's position is the centroid of its markers.
+
+    `has_orientation` is False for markers on (or within tolerance of) one
+    line, the roll about that line can't be measured so only position and
+    heading are reported.
+
+    """
+
+    def __init__(self, name, markers, tolerance=0.025):
+        markers = np.array(markers, dtype=np.float64).reshape((-1, 3))
+        if len(markers) < 2:
+            raise ValueError(f"Rigid body {name} needs at least 2 markers, got {len(markers)}")
+
+        self.name = name
+        self.markers = markers - np.mean(markers, axis=0)
+        self.tolerance = tolerance
+        self.distances = pairwise_distances(self.markers)
+
+        # Distance of each marker from the line through the markers
+        _, _, Vt = np.linalg.svd(self.markers)
+        off_axis = self.markers - np.outer(self.markers @ Vt[0], Vt[0])
+        self.has_orientation = bool(np.max(np.linalg.norm(off_axis, axis=1)) > tolerance)
+
+    def match(self, distance_matrix, available):
+        """
+        Finds the available points whose pairwise distances best fit this
+        body's markers, every distance within tolerance. Returns `(point
+        indicies in marker order, rms distance error)` or None.
+
+        """
+        num_markers = len(self.markers)
+        partial = np.flatnonzero(available)[:, np.newaxis]
+
+        for marker in range(1, num_markers):
+            allowed = np.broadcast_to(available, (len(partial), len(available))).copy()
+            for previous in range(0, marker):
+                allowed &= (
+                    np.abs(distance_matrix[partial[:, previous]] - self.distances[previous, marker])
+                    < self.tolerance
+                )
+            allowed[np.arange(len(partial))[:, np.newaxis], partial] = False
+
+            partial_indicies, point_indicies = np.nonzero(allowed)
+            if len(partial_indicies) == 0:
+                return None
+            partial = np.c_[partial[partial_indicies], point_indicies][:MAX_PARTIAL_MATCHES]
+
+        a, b = np.triu_indices(num_markers, k=1)
+        distance_errors = distance_matrix[partial[:, a], partial[:, b]] - self.distances[a, b]
+        squared_errors = np.mean(distance_errors**2, axis=1)
+        best = np.argmin(squared_errors)
+        return partial[best], np.sqrt(squared_errors[best])
+
+    def to_serializable(self):
+        return {
+            "name": self.name,
+            "markers": self.markers.tolist(),
+            "tolerance": self.tolerance,
+        }
+
+
+class RigidBodyRegistry:
+    """
+    The rigid bodies to look for in each frame. A body's index in the
+    registry is the droneIndex of the objects it produces.
+
+    """
+
+    def __init__(self, rigid_bodies=None):
+        if rigid_bodies is None:
+            rigid_bodies = default_rigid_bodies
+        self.rigid_bodies = []
+        for rigid_body in rigid_bodies:
+            self.add(rigid_body)
+
+    def add(self, rigid_body):
+        if isinstance(rigid_body, dict):
+            rigid_body = RigidBody(**rigid_body)
+        self.remove(rigid_body.name)
+        self.rigid_bodies.append(rigid_body)
+        return len(self.rigid_bodies) - 1
+
+    def remove(self, name):
+        self.rigid_bodies = [
+            rigid_body for rigid_body in self.rigid_bodies if rigid_body.name != name
+        ]
+
+    def match(self, object_points):
+        """
+        Matches the bodies against (N, 3) `object_points`, bodies with more
+        markers first so smaller patterns can't take their points. Each body
+        is matched again on the remaining points until no copy of it is left,
+        so identical objects are all found. Returns a list of `(body index,
+        point indicies, rms distance error)`.
+
+        """
+        object_points = np.asarray(object_points, dtype=np.float64).reshape((-1, 3))
+        distance_matrix = pairwise_distances(object_points)
+        available = np.ones(len(object_points), dtype=bool)
+
+        matches = []
+        for body_index in np.argsort([-len(rigid_body.markers) for rigid_body in self.rigid_bodies], kind="stable"):
+            while True:
+                match = self.rigid_bodies[body_index].match(distance_matrix, available)
+                if match is None:
+                    break
+                point_indicies, error = match
+                available[point_indicies] = False
+                matches.append((int(body_index), point_indicies, error))
+
+        return matches
+
+    def to_serializable(self):
+        return [rigid_body.to_serializable() for rigid_body in self.rigid_bodies]
+
+    def __len__(self):
+        return len(self.rigid_bodies)
+
+    def __getitem__(self, index):
+        return self.rigid_bodies[index]
+
+
+def pairwise_distances(points):
+    return np.linalg.norm(points[:, np.newaxis, :] - points[np.newaxis, :, :], axis=2)
@@ -0,0 +1,307 @@
+"""
+Session logs of the triangulated points and located objects of every frame.
+
+    python SessionLogger.py sessions/20240101-120000 exported --format csv
+
+exports a session log to one CSV (or .npy) file per stream, in chunks so
+sessions larger than memory can be exported.
+
+"""
+import argparse
+import json
+import os
+import time
+import traceback
+import numpy as np
+from BackgroundWriter import BackgroundWriter, write_json
+
+MANIFEST = "manifest.json"
+VERSION = 1
+# Frames waiting to be written
+LOG_QUEUE_SIZE = 256
+# Seconds between flushes, at most this much of a session is lost on a crash
+FLUSH_INTERVAL = 1.0
+# Records in each file of a stream before it rotates to the next one
+FILE_RECORDS = 1 << 20
+EXPORT_CHUNK_RECORDS = 1 << 16
+
+# Fixed-size little endian records, one per point or object. `body` is the
+# rigid body (droneIndex) of an object, their names are in the manifest.
+# `frame` numbers the frames given to `log`, dropped frames leave a gap
+STREAMS = {
+    "object_points": np.dtype(
+        [("frame", "<u4"), ("time", "<f8"), ("pos", "<f4", (3,)), ("error", "<f4")]
+    ),
+    "objects": np.dtype(
+        [
+            ("frame", "<u4"),
+            ("time", "<f8"),
+            ("body", "<i2"),
+            ("pos", "<f4", (3,)),
+            ("quaternion", "<f4", (4,)),
+            ("heading", "<f4"),
+            ("error", "<f4"),
+        ]
+    ),
+    "filtered_objects": np.dtype(
+        [
+            ("frame", "<u4"),
+            ("time", "<f8"),
+            ("body", "<i2"),
+            ("pos", "<f4", (3,)),
+            ("vel", "<f4", (3,)),
+            ("quaternion", "<f4", (4,)),
+            ("heading", "<f4"),
+        ]
+    ),
+}
+
+
+class SessionLogger(BackgroundWriter):
+    """
+    Appends the results of each frame to a directory of binary files, one
+    table of fixed-size records per stream (see `STREAMS`). A stream's files
+    rotate every `file_records` records. `manifest.json` lists the files,
+    their record counts and dtypes and is rewritten on every flush, so a
+    session cut short is readable up to its last flush.
+
+    `log` only queues the frame, records are built and written on a separate
+    thread, see `BackgroundWriter`. A frame that can't be turned into records
+    is skipped and counted in `failed_frames`, with the exception in
+    `last_frame_error`.
+
+    """
+
+    def __init__(self, path, file_records=FILE_RECORDS, flush_interval=FLUSH_INTERVAL):
+        self.file_records = file_records
+        self.num_frames = 0
+        self.failed_frames = 0
+        self.last_frame_error = None
+        self._next_frame = 0
+        self._manifest = {
+            "version": VERSION,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "num_frames": 0,
+            "bodies": {},
+            "streams": {
+                stream: {"dtype": np.lib.format.dtype_to_descr(dtype), "num_records": 0, "files": []}
+                for stream, dtype in STREAMS.items()
+            },
+        }
+        self._files = {}
+        super().__init__(path, LOG_QUEUE_SIZE, tick_interval=flush_interval)
+
+    def log(self, frame_time, object_points, errors, objects, filtered_objects):
+        # Returns False if the frame was dropped
+        frame = self._next_frame
+        self._next_frame += 1
+        return self._put((frame, frame_time, object_points, errors, objects, filtered_objects))
+
+    def _open(self):
+        self._write_manifest()
+
+    def _write(self, item):
+        try:
+            records = self._frame_records(*item)
+        except Exception as e:
+            if self.failed_frames == 0:
+                traceback.print_exc()
+            self.failed_frames += 1
+            self.last_frame_error = e
+        else:
+            self._write_records(item[0], item[1], records)
+
+    def _tick(self):
+        self._flush()
+
+    def _close(self):
+        self._flush()
+        for file, _ in self._files.values():
+            file.close()
+        self._files = {}
+
+    def _frame_records(self, frame, frame_time, object_points, errors, objects, filtered_objects):
+        # Records of every stream, all built before any is written so a bad
+        # frame is skipped whole
+        object_points = np.reshape(np.asarray(object_points, dtype=np.float32), (-1, 3))
+        point_records = np.zeros(len(object_points), dtype=STREAMS["object_points"])
+        point_records["pos"] = object_points
+        point_records["error"] = np.nan
+        errors = np.reshape(np.asarray(errors, dtype=np.float32), -1)[: len(object_points)]
+        point_records["error"][: len(errors)] = errors
+
+        bodies = {}
+        object_records = np.zeros(len(objects), dtype=STREAMS["objects"])
+        for i, object in enumerate(objects):
+            object_records["body"][i] = object["droneIndex"]
+            object_records["pos"][i] = object["pos"]
+            object_records["quaternion"][i] = _quaternion(object)
+            object_records["heading"][i] = object.get("heading", np.nan)
+            object_records["error"][i] = object.get("error", np.nan)
+            if "name" in object:
+                bodies[str(object["droneIndex"])] = object["name"]
+
+        filtered_records = np.zeros(len(filtered_objects), dtype=STREAMS["filtered_objects"])
+        for i, filtered_object in enumerate(filtered_objects):
+            filtered_records["body"][i] = filtered_object.get("body", filtered_object["droneIndex"])
+            filtered_records["pos"][i] = filtered_object["pos"]
+            filtered_records["vel"][i] = filtered_object["vel"]
+            filtered_records["quaternion"][i] = _quaternion(filtered_object)
+            filtered_records["heading"][i] = filtered_object.get("heading", np.nan)
+
+        return bodies, point_records, object_records, filtered_records
+
+    def _write_records(self, frame, frame_time, records):
+        bodies, point_records, object_records, filtered_records = records
+        self._manifest["bodies"].update(bodies)
+        self._append("object_points", frame, frame_time, point_records)
+        self._append("objects", frame, frame_time, object_records)
+        self._append("filtered_objects", frame, frame_time, filtered_records)
+        self.num_frames += 1
+
+    def _append(self, stream, frame, frame_time, records):
+        records["frame"] = frame
+        records["time"] = frame_time
+        while len(records) != 0:
+            file, file_manifest = self._open_file(stream)
+            count = min(len(records), self.file_records - file_manifest["num_records"])
+            file.write(records[:count].tobytes())
+            file_manifest["num_records"] += count
+            self._manifest["streams"][stream]["num_records"] += count
+            records = records[count:]
+
+    def _open_file(self, stream):
+        # The stream's current file, rotating to a new one once it's full
+        if stream in self._files:
+            file, file_manifest = self._files[stream]
+            if file_manifest["num_records"] < self.file_records:
+                return file, file_manifest
+            file.close()
+
+        files = self._manifest["streams"][stream]["files"]
+        file_manifest = {"file": f"{stream}_{len(files):05d}.bin", "num_records": 0}
+        files.append(file_manifest)
+        file = open(os.path.join(self.path, file_manifest["file"]), "wb")
+        self._files[stream] = (file, file_manifest)
+        return file, file_manifest
+
+    def _flush(self):
+        for file, _ in self._files.values():
+            file.flush()
+        self._manifest["num_frames"] = self.num_frames
+        self._write_manifest()
+
+    def _write_manifest(self):
+        write_json(os.path.join(self.path, MANIFEST), self._manifest)
+
+
+def _quaternion(object):
+    if object.get("quaternion") is None:
+        return [np.nan] * 4
+    return object["quaternion"]
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest["version"] != VERSION:
+        raise ValueError(f"Unsupported session log version {manifest['version']}")
+    return manifest
+
+
+# Yields the records of one stream of a session log in chunks of at most
+# `chunk_records`, files are memory mapped so only one chunk is in memory
+def read_session_log(path, stream, chunk_records=EXPORT_CHUNK_RECORDS):
+    stream_manifest = read_manifest(path)["streams"][stream]
+    dtype = _dtype(stream_manifest["dtype"])
+    for file_manifest in stream_manifest["files"]:
+        if file_manifest["num_records"] == 0:
+            continue
+        records = np.memmap(
+            os.path.join(path, file_manifest["file"]),
+            dtype=dtype,
+            mode="r",
+            shape=(file_manifest["num_records"],),
+        )
+        for start in range(0, len(records), chunk_records):
+            yield np.array(records[start : start + chunk_records])
+
+
+def _dtype(descr):
+    # JSON turns the descr's tuples, field shapes included, into lists
+    return np.dtype(
+        [tuple(tuple(value) if isinstance(value, list) else value for value in field) for field in descr]
+    )
+
+
+# Writes each stream of a session log to `output_path`/<stream>.csv (or .npy),
+# reading and writing `chunk_records` records at a time
+def export_session_log(path, output_path, format="csv", chunk_records=EXPORT_CHUNK_RECORDS):
+    if format not in ["csv", "npy"]:
+        raise ValueError(f"Unknown export format {format}")
+    manifest = read_manifest(path)
+    os.makedirs(output_path, exist_ok=True)
+
+    exported = []
+    for stream, stream_manifest in manifest["streams"].items():
+        dtype = _dtype(stream_manifest["dtype"])
+        output_file = os.path.join(output_path, f"{stream}.{format}")
+        chunks = read_session_log(path, stream, chunk_records)
+
+        if format == "npy":
+            output = np.lib.format.open_memmap(
+                output_file, mode="w+", dtype=dtype, shape=(stream_manifest["num_records"],)
+            )
+            start = 0
+            for records in chunks:
+                output[start : start + len(records)] = records
+                start += len(records)
+            output.flush()
+            del output
+        else:
+            columns, formats = _csv_columns(dtype)
+            with open(output_file, "w") as f:
+                f.write(",".join(columns) + "\n")
+                for records in chunks:
+                    np.savetxt(f, _flatten(records), fmt=formats, delimiter=",")
+        exported.append(output_file)
+
+    with open(os.path.join(output_path, "bodies.json"), "w") as f:
+        json.dump(manifest["bodies"], f, indent=2)
+    return exported
+
+
+def _csv_columns(dtype):
+    columns = []
+    formats = []
+    for name in dtype.names:
+        field_dtype, _ = dtype.fields[name]
+        shape = field_dtype.shape
+        suffixes = ["x", "y", "z"] if shape == (3,) else ["x", "y", "z", "w"] if shape == (4,) else [""]
+        value_format = "%d" if field_dtype.base.kind in "iu" else "%.6f" if name == "time" else "%.6g"
+        for suffix in suffixes:
+            columns.append(f"{name}_{suffix}" if suffix else name)
+            formats.append(value_format)
+    return columns, formats
+
+
+def _flatten(records):
+    return np.column_stack(
+        [records[name].reshape((len(records), -1)).astype(np.float64) for name in records.dtype.names]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("session", help="Session log directory")
+    parser.add_argument("output", help="Directory to write the exported streams to")
+    parser.add_argument("--format", choices=["csv", "npy"], default="csv")
+    parser.add_argument("--chunk-records", type=int, default=EXPORT_CHUNK_RECORDS)
+    args = parser.parse_args()
+
+    for output_file in export_session_log(args.session, args.output, args.format, args.chunk_records):
+        print(f"Exported {output_file}")
+
+
+if __name__ == "__main__":
+    main()
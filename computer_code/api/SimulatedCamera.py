@@ -0,0 +1,207 @@
+import time
+import numpy as np
+import cv2 as cv
+from settings import intrinsic_matrices as default_intrinsic_matrices
+from settings import distortion_coefs as default_distortion_coefs
+from helpers import square_offset
+
+# Sub-pixel bits used when drawing blobs, see cv.circle
+DRAW_SHIFT = 4
+
+
+class SimulatedCamera:
+    """
+    Camera source rendering IR markers moving along known trajectories, usable
+    by `Cameras` in place of `pseyepy.Camera`. Markers are projected through
+    each camera's pose, intrinsics and distortion into raw (unsquared,
+    distorted) frames, with pixel noise, random occlusion and spurious
+    reflections.
+
+    Cameras are spread on a ring looking at the middle of the capture volume.
+    `camera_poses` are relative to camera 0, like a pose calibration, and
+    `ground_truth` holds the markers of the last frame in the same frame.
+    `visibility` marks, per marker and camera, the blobs that were drawn
+    apart from any other blob.
+    With more cameras than `settings` has intrinsics they are reused in turn.
+
+    """
+
+    def __init__(
+        self,
+        num_cameras=4,
+        num_markers=2,
+        trajectories=None,
+        fps=125,
+        resolution=(320, 240),
+        ring_radius=3.0,
+        ring_height=2.0,
+        pixel_noise=0.2,
+        occlusion_probability=0.0,
+        reflection_rate=0.0,
+        blob_radius=2,
+        realtime=True,
+        seed=0,
+    ):
+        self.num_cameras = num_cameras
+        self.num_markers = num_markers
+        self.fps = fps
+        self.resolution = resolution
+        self.pixel_noise = pixel_noise
+        self.occlusion_probability = occlusion_probability
+        self.reflection_rate = reflection_rate
+        self.blob_radius = blob_radius
+        self.realtime = realtime
+        self.rng = np.random.default_rng(seed)
+        # Accepted and ignored, as on a live camera they are hardware settings
+        self.exposure = [0] * num_cameras
+        self.gain = [0] * num_cameras
+
+        if trajectories is None:
+            trajectories = lissajous_trajectories(num_markers, seed=seed)
+        self.trajectories = trajectories
+
+        self.intrinsic_matrices = [
+            default_intrinsic_matrices[i % len(default_intrinsic_matrices)] for i in range(num_cameras)
+        ]
+        self.distortion_coefs = [
+            default_distortion_coefs[i % len(default_distortion_coefs)] for i in range(num_cameras)
+        ]
+
+        scene_poses = ring_camera_poses(num_cameras, ring_radius, ring_height)
+        # Scene to camera 0 frame, the frame a pose calibration solves in
+        self._scene_R = scene_poses[0]["R"]
+        self._scene_t = scene_poses[0]["t"]
+        self.camera_poses = [
+            {
+                "R": pose["R"] @ self._scene_R.T,
+                "t": pose["t"] - pose["R"] @ self._scene_R.T @ self._scene_t,
+            }
+            for pose in scene_poses
+        ]
+
+        self.frame_index = 0
+        self.ground_truth = np.empty((0, 3))
+        self.visibility = np.zeros((num_markers, num_cameras), dtype=bool)
+        self._start_time = time.time()
+
+    def read(self, squeeze=False):
+        frame_time = self.frame_index / self.fps
+        if self.realtime:
+            delay = self._start_time + frame_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        scene_points = np.asarray(self.trajectories(frame_time), dtype=np.float64).reshape((-1, 3))
+        self.ground_truth = scene_points @ self._scene_R.T + self._scene_t[:, 0]
+        self.visibility = np.zeros((len(scene_points), self.num_cameras), dtype=bool)
+
+        frames = [self._render(i) for i in range(0, self.num_cameras)]
+        self.frame_index += 1
+
+        timestamps = [self._start_time + frame_time] * self.num_cameras
+        if squeeze and self.num_cameras == 1:
+            return frames[0], timestamps[0]
+        return frames, timestamps
+
+    def _render(self, camera):
+        width, height = self.resolution
+        frame = np.zeros((height, width, 3), dtype=np.uint8)
+        pose = self.camera_poses[camera]
+
+        in_front = (self.ground_truth @ pose["R"].T + pose["t"][:, 0])[:, 2] > 0
+        projected_points = np.empty((0, 2))
+        if np.any(in_front):
+            projected_points, _ = cv.projectPoints(
+                self.ground_truth[in_front],
+                cv.Rodrigues(pose["R"])[0],
+                pose["t"],
+                self.intrinsic_matrices[camera],
+                self.distortion_coefs[camera],
+            )
+            # Intrinsics are for the squared frame, raw frames aren't padded
+            projected_points = projected_points[:, 0, :] - square_offset(frame.shape)
+            projected_points += self.rng.normal(0, self.pixel_noise, projected_points.shape)
+
+        visible = np.zeros(len(self.ground_truth), dtype=bool)
+        visible[in_front] = (
+            np.all((projected_points >= 0) & (projected_points < [width, height]), axis=1)
+            & (self.rng.random(len(projected_points)) >= self.occlusion_probability)
+        )
+        projected_points = projected_points[visible[in_front]]
+
+        num_reflections = self.rng.poisson(self.reflection_rate)
+        reflections = self.rng.uniform([0, 0], [width, height], (num_reflections, 2))
+
+        # Blobs close enough to merge can't be told apart, those markers
+        # don't count as visible
+        blobs = np.vstack([projected_points, reflections])
+        distances = np.linalg.norm(blobs[:len(projected_points), np.newaxis] - blobs[np.newaxis], axis=2)
+        np.fill_diagonal(distances[:, :len(projected_points)], np.inf)
+        merged = np.any(distances < 2 * self.blob_radius + 2, axis=1)
+        visible[np.flatnonzero(visible)[merged]] = False
+        self.visibility[:, camera] = visible
+
+        for x, y in blobs:
+            cv.circle(
+                frame,
+                (int(round(x * (1 << DRAW_SHIFT))), int(round(y * (1 << DRAW_SHIFT)))),
+                self.blob_radius << DRAW_SHIFT,
+                (255, 255, 255),
+                -1,
+                cv.LINE_AA,
+                DRAW_SHIFT,
+            )
+        return frame
+
+    def end(self):
+        pass
+
+
+# Cameras evenly spaced on a horizontal ring, all looking at `target`. Poses
+# map scene points (z up) into each camera, x_c = R @ X + t
+def ring_camera_poses(num_cameras, radius, height, target=(0, 0, 0)):
+    target = np.array(target, dtype=np.float64)
+    camera_poses = []
+    for angle in np.linspace(0, 2 * np.pi, num_cameras, endpoint=False):
+        center = np.array([radius * np.cos(angle), radius * np.sin(angle), height])
+        forward = (target - center) / np.linalg.norm(target - center)
+        right = np.cross(forward, [0, 0, 1])
+        right /= np.linalg.norm(right)
+        down = np.cross(forward, right)
+        R = np.array([right, down, forward])
+        camera_poses.append({"R": R, "t": (-R @ center)[:, np.newaxis]})
+    return camera_poses
+
+
+# Markers on smooth, repeating 3D Lissajous curves inside a `size` cube
+# centred on the origin, returns a function of time giving (M, 3) positions
+def lissajous_trajectories(num_markers, size=1.0, seed=0):
+    rng = np.random.default_rng(seed)
+    frequencies = rng.uniform(0.1, 0.5, (num_markers, 3))
+    phases = rng.uniform(0, 2 * np.pi, (num_markers, 3))
+
+    def trajectories(t):
+        return size / 2 * np.sin(2 * np.pi * frequencies * t + phases)
+
+    return trajectories
+
+
+# Rigid marker constellations on Lissajous paths, each body also spinning
+# about its z axis. `markers` is the (M, 3) template shared by every body
+def rigid_body_trajectories(num_bodies, markers, size=1.0, spin=1.0, seed=0):
+    markers = np.asarray(markers, dtype=np.float64)
+    centers = lissajous_trajectories(num_bodies, size, seed)
+
+    def trajectories(t):
+        angles = spin * t + np.arange(num_bodies)
+        c, s = np.cos(angles), np.sin(angles)
+        rotations = np.zeros((num_bodies, 3, 3))
+        rotations[:, 0, 0] = c
+        rotations[:, 0, 1] = -s
+        rotations[:, 1, 0] = s
+        rotations[:, 1, 1] = c
+        rotations[:, 2, 2] = 1
+        points = np.einsum("bij,mj->bmi", rotations, markers) + centers(t)[:, np.newaxis, :]
+        return points.reshape((-1, 3))
+
+    return trajectories
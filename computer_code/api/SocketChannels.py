@@ -0,0 +1,202 @@
+import queue
+import threading
+import time
+import traceback
+import numpy as np
+from wire_format import encode_object_points
+
+# Messages waiting to be sent, the oldest is dropped once this many are queued
+EMIT_QUEUE_SIZE = 8
+
+
+class WireFormats():
+    Json = 0
+    Binary = 1
+
+
+class Channels():
+    ImagePoints = "image-points"
+    ObjectPoints = "object-points"
+    Objects = "objects"
+    FilteredObjects = "filtered-objects"
+    Fps = "fps"
+    All = [ImagePoints, ObjectPoints, Objects, FilteredObjects, Fps]
+
+
+class ClientSubscription:
+    def __init__(self):
+        self.wire_format = WireFormats.Json
+        # Max messages per second of each subscribed channel, None is every frame
+        self.max_rates = {channel: None for channel in Channels.All}
+        self.last_sent = {channel: 0 for channel in Channels.All}
+
+    def due(self, channel, now):
+        if channel not in self.max_rates:
+            return False
+        max_rate = self.max_rates[channel]
+        return max_rate is None or now - self.last_sent[channel] >= 1 / max_rate
+
+
+class SocketChannels:
+    """
+    Per-client delivery of the capture loop's data. Each connected client
+    picks the channels it wants, a max rate for each and its wire format,
+    new clients get every channel at the full frame rate as JSON.
+
+    The capture loop only queues messages, serialisation and sending happen on
+    the emitter thread. The queue is bounded and drops its oldest message when
+    full so a slow server never holds back capture. Clients with the same
+    format and the same channels due share one serialised message.
+
+    """
+
+    def __init__(self, socketio):
+        self.socketio = socketio
+        self.dropped_messages = 0
+        # Seconds spent building messages in each wire format, JSON messages
+        # are only turned into text by the Socket.IO server
+        self.serialise_seconds = {WireFormats.Json: 0.0, WireFormats.Binary: 0.0}
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=EMIT_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._emit_loop, daemon=True)
+        self._thread.start()
+
+    def add_client(self, sid):
+        with self._lock:
+            self._clients[sid] = ClientSubscription()
+
+    def remove_client(self, sid):
+        with self._lock:
+            self._clients.pop(sid, None)
+
+    def subscribe(self, sid, channels):
+        """
+        Replaces the client's channels with `channels`, a dict of channel name
+        to max rate in Hz (None for every frame).
+
+        """
+        unknown = [channel for channel in channels if channel not in Channels.All]
+        if len(unknown) != 0:
+            raise ValueError(f"Unknown channels {unknown}")
+        for max_rate in channels.values():
+            if max_rate is not None and max_rate <= 0:
+                raise ValueError(f"Max rate must be positive, got {max_rate}")
+
+        with self._lock:
+            subscription = self._clients.setdefault(sid, ClientSubscription())
+            subscription.max_rates = dict(channels)
+
+    def set_wire_format(self, sid, wire_format):
+        if wire_format not in [WireFormats.Json, WireFormats.Binary]:
+            raise RuntimeError(f"Unknown wire format {wire_format}")
+        with self._lock:
+            self._clients.setdefault(sid, ClientSubscription()).wire_format = wire_format
+
+    def client_count(self):
+        return len(self._clients)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def wait_until_sent(self):
+        # Blocks until every queued message has been sent or dropped
+        self._queue.join()
+
+    def publish(self, channel, event, data):
+        self._enqueue((self._send_channel, (channel, event, data)))
+
+    def publish_object_points(self, time_ms, image_points, object_points, errors, objects, filtered_objects):
+        self._enqueue(
+            (
+                self._send_object_points,
+                (time_ms, image_points, object_points, errors, objects, filtered_objects),
+            )
+        )
+
+    def _enqueue(self, message):
+        while True:
+            try:
+                self._queue.put_nowait(message)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+                    self.dropped_messages += 1
+                except queue.Empty:
+                    pass
+
+    def _emit_loop(self):
+        while True:
+            send, args = self._queue.get()
+            try:
+                send(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+    def _due_clients(self, channels, now):
+        # Claims the sends, groups clients by (wire format, due channels)
+        groups = {}
+        with self._lock:
+            for sid, subscription in self._clients.items():
+                due = tuple(channel for channel in channels if subscription.due(channel, now))
+                if len(due) == 0:
+                    continue
+                for channel in due:
+                    subscription.last_sent[channel] = now
+                groups.setdefault((subscription.wire_format, due), []).append(sid)
+        return groups
+
+    def _send_channel(self, channel, event, data):
+        for _, sids in self._due_clients([channel], time.time()).items():
+            for sid in sids:
+                self.socketio.emit(event, data, to=sid)
+
+    def _send_object_points(self, time_ms, image_points, object_points, errors, objects, filtered_objects):
+        channels = [Channels.ImagePoints, Channels.ObjectPoints, Channels.Objects, Channels.FilteredObjects]
+        groups = self._due_clients(channels, time.time())
+
+        for (wire_format, due), sids in groups.items():
+            # Channels that aren't due are left out of the message
+            message_image_points = image_points if Channels.ImagePoints in due else None
+            message_object_points = object_points if Channels.ObjectPoints in due else None
+            message_errors = errors if Channels.ObjectPoints in due else None
+            message_objects = objects if Channels.Objects in due else None
+            message_filtered_objects = filtered_objects if Channels.FilteredObjects in due else None
+
+            serialise_start = time.perf_counter()
+            if wire_format == WireFormats.Binary:
+                event = "object-points-binary"
+                data = encode_object_points(
+                    time_ms,
+                    message_image_points,
+                    message_object_points,
+                    message_errors,
+                    message_objects,
+                    message_filtered_objects,
+                )
+            else:
+                event = "object-points"
+                data = {"time_ms": time_ms}
+                if message_image_points is not None:
+                    data["image_points"] = message_image_points
+                if message_object_points is not None:
+                    data["object_points"] = np.asarray(message_object_points).tolist()
+                    data["errors"] = np.asarray(message_errors).tolist()
+                if message_objects is not None:
+                    data["objects"] = [
+                        {
+                            k: (v.tolist() if isinstance(v, np.ndarray) else v)
+                            for (k, v) in object.items()
+                        }
+                        for object in message_objects
+                    ]
+                if message_filtered_objects is not None:
+                    data["filtered_objects"] = message_filtered_objects
+            self.serialise_seconds[wire_format] += time.perf_counter() - serialise_start
+
+            for sid in sids:
+                self.socketio.emit(event, data, to=sid)
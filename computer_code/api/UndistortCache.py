@@ -0,0 +1,44 @@
+import numpy as np
+import cv2 as cv
+
+
+class UndistortCache:
+    """
+    Per-camera undistortion remap tables. `cv.undistort` rebuilds the
+    distortion map on every call, here the map is built once with
+    `cv.initUndistortRectifyMap` (fixed-point, CV_16SC2) and only rebuilt when
+    the camera's intrinsics, distortion coefficients or the frame size change.
+
+    """
+
+    def __init__(self):
+        self._keys = {}
+        self._maps = {}
+
+    def undistort(self, camera, frame, intrinsic_matrix, distortion_coefs):
+        map1, map2 = self.get_maps(camera, frame.shape, intrinsic_matrix, distortion_coefs)
+        return cv.remap(frame, map1, map2, cv.INTER_LINEAR)
+
+    def get_maps(self, camera, frame_shape, intrinsic_matrix, distortion_coefs):
+        height, width = frame_shape[:2]
+        key = (
+            width,
+            height,
+            np.asarray(intrinsic_matrix, dtype=np.float64).tobytes(),
+            np.asarray(distortion_coefs, dtype=np.float64).tobytes(),
+        )
+        if self._keys.get(camera) != key:
+            self._maps[camera] = cv.initUndistortRectifyMap(
+                intrinsic_matrix,
+                distortion_coefs,
+                None,
+                intrinsic_matrix,
+                (width, height),
+                cv.CV_16SC2,
+            )
+            self._keys[camera] = key
+        return self._maps[camera]
+
+    def clear(self):
+        self._keys = {}
+        self._maps = {}
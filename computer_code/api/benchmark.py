@@ -0,0 +1,280 @@
+"""
+Runs the capture pipeline (`Cameras._camera_read`) on simulated cameras over
+a grid of camera counts, marker counts and frame rates, and writes per-stage
+latency percentiles, throughput and 3D accuracy for every scenario as JSON.
+
+    python benchmark.py --cameras 4 8 --bodies 1 4 --fps 60 125 --output results.json
+
+Markers are grouped in rigid bodies of three so object detection runs too.
+The frame rate sets how far markers move between frames and the frame budget
+the results are compared against, frames are processed as fast as possible.
+
+Two clients subscribed to every channel, one per wire format, receive each
+frame. The emit stage lasts until both messages are serialised and sent, and
+the time spent serialising each format is reported separately.
+
+"""
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import time
+import numpy as np
+import cv2 as cv
+from scipy.spatial import cKDTree
+
+from cameras import Cameras, ProcessingModes
+from SocketChannels import WireFormats
+from SimulatedCamera import SimulatedCamera, rigid_body_trajectories
+
+STAGES = [
+    "read",
+    "image_processing",
+    "point_capture",
+    "correspondance",
+    "triangulation",
+    "object_detection",
+    "emit",
+]
+# Three marker template of the simulated rigid bodies, in meters
+BODY_MARKERS = [[0, 0, 0], [0.1, 0, 0], [0, 0.17, 0]]
+# Triangulated points further than this from every marker count as spurious
+MATCH_DISTANCE = 0.02
+CLIENTS = {"benchmark-json": WireFormats.Json, "benchmark-binary": WireFormats.Binary}
+
+
+class SerialisingSocketIO:
+    # Stands in for the Socket.IO server, turning messages into JSON as it
+    # would before sending. Binary messages are sent as they are
+    def __init__(self):
+        self.serialise_seconds = 0.0
+
+    def emit(self, event, data=None, to=None, **kwargs):
+        if isinstance(data, (bytes, bytearray)):
+            return
+        start = time.perf_counter()
+        json.dumps([event, data], separators=(",", ":"))
+        self.serialise_seconds += time.perf_counter() - start
+
+
+def run_scenario(cameras, num_cameras, num_bodies, fps, frames, warmup, processing_mode, occlusion_probability, reflection_rate, seed):
+    source = SimulatedCamera(
+        num_cameras=num_cameras,
+        num_markers=num_bodies * len(BODY_MARKERS),
+        trajectories=rigid_body_trajectories(num_bodies, BODY_MARKERS, seed=seed),
+        fps=fps,
+        occlusion_probability=occlusion_probability,
+        reflection_rate=reflection_rate,
+        realtime=False,
+        seed=seed,
+    )
+    cameras.set_camera_source(source)
+    socketio = cameras.socketio
+    socket_channels = cameras.socket_channels
+    for sid, wire_format in CLIENTS.items():
+        socket_channels.add_client(sid)
+        socket_channels.set_wire_format(sid, wire_format)
+    cameras.to_world_coords_matrix = np.eye(4)
+    cameras.set_processing_mode(processing_mode)
+    cameras.set_rigid_bodies(
+        [
+            {"name": f"body_{i}", "markers": BODY_MARKERS, "tolerance": 0.01}
+            for i in range(num_bodies)
+        ]
+    )
+
+    frame_results = []
+    emit_data = cameras._emit_data
+
+    def record_emit_data(time_ms, image_points, object_points, errors, objects, filtered_objects):
+        frame_results.append((np.array(object_points), source.ground_truth, source.visibility))
+        emit_data(time_ms, image_points, object_points, errors, objects, filtered_objects)
+
+    cameras._emit_data = record_emit_data
+    cameras.start_capturing_points()
+    cameras.start_triangulating_points(source.camera_poses)
+    cameras.start_object_detection()
+
+    stage_timings = {stage: [] for stage in STAGES}
+    serialise_timings = {"json": [], "binary": []}
+    totals = []
+    try:
+        for frame in range(0, warmup + frames):
+            channels_serialise = dict(socket_channels.serialise_seconds)
+            socketio_serialise = socketio.serialise_seconds
+            start = time.perf_counter()
+            cameras._camera_read()
+            # Messages are sent on the emitter thread, wait for them
+            send_start = time.perf_counter()
+            socket_channels.wait_until_sent()
+            end = time.perf_counter()
+            if frame < warmup:
+                continue
+            totals.append((end - start) * 1000)
+            for stage in STAGES:
+                if stage in cameras.stage_timings:
+                    stage_timings[stage].append(cameras.stage_timings[stage])
+            stage_timings["emit"][-1] += (end - send_start) * 1000
+            serialise_timings["json"].append(
+                (
+                    socket_channels.serialise_seconds[WireFormats.Json]
+                    - channels_serialise[WireFormats.Json]
+                    + socketio.serialise_seconds
+                    - socketio_serialise
+                )
+                * 1000
+            )
+            serialise_timings["binary"].append(
+                (socket_channels.serialise_seconds[WireFormats.Binary] - channels_serialise[WireFormats.Binary])
+                * 1000
+            )
+    finally:
+        cameras.stop_object_detection()
+        cameras.stop_triangulating_points()
+        cameras.stop_capturing_points()
+        cameras._emit_data = emit_data
+        for sid in CLIENTS:
+            socket_channels.remove_client(sid)
+
+    return {
+        "cameras": num_cameras,
+        "bodies": num_bodies,
+        "markers": num_bodies * len(BODY_MARKERS),
+        "fps": fps,
+        "processing_mode": "points-only" if processing_mode == ProcessingModes.PointsOnly else "full-frame",
+        "frames": frames,
+        "frame_budget_ms": 1000 / fps,
+        "throughput_fps": len(totals) / (np.sum(totals) / 1000),
+        "total_ms": summarize(totals),
+        "stages_ms": {
+            stage: summarize(timings) for stage, timings in stage_timings.items() if len(timings) != 0
+        },
+        "serialise_ms": {
+            wire_format: summarize(timings) for wire_format, timings in serialise_timings.items()
+        },
+        "accuracy": accuracy(cameras, frame_results[warmup:]),
+    }
+
+
+def summarize(values):
+    values = np.asarray(values, dtype=np.float64)
+    return {
+        "mean": float(np.mean(values)),
+        "p50": float(np.percentile(values, 50)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(np.max(values)),
+    }
+
+
+def accuracy(cameras, frame_results):
+    # Triangulated points against the markers seen by at least two cameras
+    errors = []
+    found_markers = 0
+    visible_markers = 0
+    spurious_points = 0
+    for object_points, ground_truth, visibility in frame_results:
+        triangulatable = np.sum(visibility, axis=1) >= 2
+        visible_markers += np.sum(triangulatable)
+        if len(object_points) == 0:
+            continue
+        markers = cameras._to_world_coords(ground_truth)
+        distances, indicies = cKDTree(markers).query(object_points.reshape((-1, 3)))
+        matched = distances < MATCH_DISTANCE
+        errors.extend(distances[matched])
+        spurious_points += np.sum(~matched)
+        found_markers += len(np.intersect1d(indicies[matched], np.flatnonzero(triangulatable)))
+
+    result = {
+        "recall": float(found_markers / visible_markers) if visible_markers else None,
+        "spurious_points_per_frame": float(spurious_points / max(len(frame_results), 1)),
+        "error_m": None,
+    }
+    if len(errors) != 0:
+        result["error_m"] = {
+            "median": float(np.median(errors)),
+            "p95": float(np.percentile(errors, 95)),
+            "max": float(np.max(errors)),
+        }
+    return result
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cameras", type=int, nargs="+", default=[4, 8])
+    parser.add_argument("--bodies", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--fps", type=int, nargs="+", default=[60, 125])
+    parser.add_argument("--frames", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--processing-mode", choices=["full-frame", "points-only"], default="full-frame")
+    parser.add_argument("--occlusion", type=float, default=0.05, help="Probability a marker is hidden from a camera")
+    parser.add_argument("--reflections", type=float, default=0.5, help="Mean spurious reflections per camera per frame")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    processing_mode = ProcessingModes.PointsOnly if args.processing_mode == "points-only" else ProcessingModes.FullFrame
+    cameras = Cameras.instance()
+    cameras.set_socketio(SerialisingSocketIO())
+
+    results = []
+    try:
+        for num_cameras, num_bodies, fps in itertools.product(args.cameras, args.bodies, args.fps):
+            result = run_scenario(
+                cameras,
+                num_cameras,
+                num_bodies,
+                fps,
+                args.frames,
+                args.warmup,
+                processing_mode,
+                args.occlusion,
+                args.reflections,
+                args.seed,
+            )
+            results.append(result)
+            error = result["accuracy"]["error_m"]
+            print(
+                f"{num_cameras} cameras, {result['markers']} markers, {fps} fps: "
+                f"{result['throughput_fps']:.1f} fps, p99 {result['total_ms']['p99']:.2f} ms "
+                f"(budget {result['frame_budget_ms']:.2f} ms), "
+                f"serialise p50 json {result['serialise_ms']['json']['p50']:.3f} ms "
+                f"binary {result['serialise_ms']['binary']['p50']:.3f} ms, "
+                f"median error {error['median'] * 1000 if error else float('nan'):.1f} mm"
+            )
+    finally:
+        cameras.end()
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "environment": environment(),
+                "settings": vars(args),
+                "scenarios": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
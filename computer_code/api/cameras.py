@@ -1,19 +1,62 @@
 import os
 import time
 import uuid
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2 as cv
 from settings import intrinsic_matrices, distortion_coefs
-from pseyepy import Camera, cam_count
+try:
+    from pseyepy import Camera, cam_count
+except ImportError:
+    # Recorded and simulated camera sources work without pseyepy
+    Camera = None
+    cam_count = None
 from Singleton import Singleton
 from KalmanFilter import KalmanFilter
+from FrameBuffer import FrameBuffer
+from FrameRecorder import FrameRecorder
+from SessionLogger import SessionLogger
+from UndistortCache import UndistortCache
+from Calibration import Calibration
+from RigidBodies import RigidBodyRegistry
+from SocketChannels import SocketChannels, Channels
+from Metrics import MetricsRegistry
 from helpers import (
-    find_point_correspondance_and_object_points,
+    find_point_correspondances,
+    triangulate_points_batch,
+    reprojection_errors_batch,
     locate_objects,
     make_square,
+    square_offset,
+    merge_windows,
+    find_blobs,
+    undistort_image_points,
 )
 
 DEFAULT_FPS = 125
+FPS_AVERAGE_FRAMES = 20
+# Seconds to wait after a failed frame, doubling with each failure in a row up
+# to the max. Capture stops after MAX_CAPTURE_FAILURES failures in a row
+CAPTURE_RETRY_DELAY = 0.01
+MAX_CAPTURE_RETRY_DELAY = 1.0
+MAX_CAPTURE_FAILURES = 20
+# Candidate point groups kept per root point when matching points between cameras
+MAX_CORRESPONDANCE_HYPOTHESES = 8
+# Threads used to process camera frames concurrently, None uses one per camera
+DEFAULT_WORKERS = None
+# Track slots in the object tracker, bounds its memory and the droneIndex range
+MAX_TRACKED_OBJECTS = 16
+SHARPEN_KERNEL = np.array(
+    [
+        [-2, -1, -1, -1, -2],
+        [-1,  1,  3,  1, -1],
+        [-1,  3,  4,  3, -1],
+        [-1,  1,  3,  1, -1],
+        [-2, -1, -1, -1, -2],
+    ]
+)
 class States():
     CamerasNotFound = 0
     CamerasFound = 1
@@ -23,20 +66,119 @@ class States():
     Triangulation = 5
     ObjectDetection = 6
 
+class ProcessingModes():
+    # Undistort, sharpen and colour convert every frame before finding dots
+    FullFrame = 0
+    # Find dots on the raw frames and only undistort the resulting centroids
+    PointsOnly = 1
+
+class OverlayModes():
+    # Annotate frames only while at least one camera stream is open
+    Auto = 0
+    Always = 1
+    Never = 2
+
 @Singleton
 class Cameras:
     def __init__(self):
         self.camera_poses = None
+        self.calibration = None
         self.projection_matrices = None
         self.to_world_coords_matrix = None
-
-        self.kalman_filter = KalmanFilter(1)
+        self.intrinsic_matrices = intrinsic_matrices
+        self.distortion_coefs = distortion_coefs
+
+        self.kalman_filter = KalmanFilter(MAX_TRACKED_OBJECTS)
+        self.rigid_bodies = RigidBodyRegistry()
+        self.undistort_cache = UndistortCache()
+        self.processing_mode = ProcessingModes.FullFrame
+        self.overlay_mode = OverlayModes.Auto
         self.socketio = None
+        self.socket_channels = None
+
+        # Region of interest tracking, once objects are located only small
+        # windows around their predicted positions are scanned for dots
+        self.max_correspondance_hypotheses = MAX_CORRESPONDANCE_HYPOTHESES
+        self.roi_tracking = False
+        self.roi_radius = 24
+        self.roi_full_scan_interval = 30
+        self._roi_points = None
+        self._roi_marker_lost = True
+        self._frames_since_full_scan = 0
+        self._last_read_time = None
+        self._last_timestamp = None
+        self._frame_interval = 1 / DEFAULT_FPS
+
+        # OpenCV releases the GIL, so per-camera work can run on a thread pool.
+        # Durations of the most recent frame's pipeline stages, in ms
+        self.worker_pool = None
+        self.stage_timings = {}
+
+        # A single capture thread runs the pipeline once per hardware frame and
+        # publishes the result, consumers subscribe to the frame buffer
+        self.frame_buffer = FrameBuffer()
+        self.capture_thread = None
+        self.is_capturing = False
+        # Why capture last stopped by itself, None if it didn't
+        self.capture_error = None
+        self._jpeg_lock = threading.Lock()
+        self._jpeg_sequence = None
+        self._jpeg_cache = {}
+        self.frame_recorder = None
+        self.session_logger = None
+
+        # Pipeline instrumentation, scraped in the Prometheus text format
+        self.metrics = MetricsRegistry("mocap_")
+        self._create_metrics()
+
         self.initialize_cameras(DEFAULT_FPS)    
 
+    def _create_metrics(self):
+        metrics = self.metrics
+        self.stage_duration = metrics.histogram(
+            "stage_duration_seconds", "Duration of each capture pipeline stage", ["stage"]
+        )
+        self.frame_duration = metrics.histogram(
+            "frame_duration_seconds", "Duration of the whole capture pipeline for one frame"
+        )
+        self.frame_budget = metrics.gauge(
+            "frame_budget_seconds", "Time between camera frames at the target frame rate"
+        )
+        self.frame_budget.set_function(lambda: 1 / self.target_fps)
+        self.frames_processed = metrics.counter("frames_processed", "Frames run through the pipeline")
+        self.dropped_frames = metrics.counter(
+            "dropped_frames",
+            "Frames lost, missed by the pipeline (camera), failed in it (error), "
+            "not recorded (recorder) or not logged (session_log)",
+            ["reason"],
+        )
+        for reason in ["camera", "error", "recorder", "session_log"]:
+            self.dropped_frames.labels(reason)
+        self.blobs = metrics.gauge("blobs", "Blobs found in the last frame of each camera", ["camera"])
+        self.blobs_found = metrics.counter("blobs_found", "Blobs found in each camera", ["camera"])
+        self.correspondance_hypotheses = metrics.counter(
+            "correspondance_hypotheses", "Point correspondance hypotheses scored"
+        )
+        self.object_points = metrics.gauge("object_points", "Points triangulated in the last frame")
+        metrics.gauge(
+            "emit_queue_depth", "Messages waiting to be sent to clients"
+        ).set_function(lambda: self.socket_channels.queue_depth() if self.socket_channels else 0)
+        metrics.counter(
+            "emit_dropped_messages", "Messages dropped because the emit queue was full"
+        ).set_function(lambda: self.socket_channels.dropped_messages if self.socket_channels else 0)
+        metrics.gauge("socket_clients", "Connected Socket.IO clients").set_function(
+            lambda: self.socket_channels.client_count() if self.socket_channels else 0
+        )
+        metrics.gauge("stream_subscribers", "Open camera streams").set_function(
+            lambda: self.frame_buffer.subscriber_count()
+        )
+
     def initialize_cameras(self, target_fps):
         print("\nInitializing cameras")
+        self.target_fps = target_fps
         try:
+            if Camera is None:
+                raise ImportError("pseyepy is not installed")
             self.cameras = Camera(
                 fps=target_fps, resolution=Camera.RES_SMALL, colour=True, gain=1, exposure=100
             )
@@ -45,13 +187,157 @@ class Cameras:
             self.capture_state = States.CamerasNotFound
 
         if self.capture_state >= States.CamerasFound:
-            print(f"{cam_count()} cameras found")
+            self.num_cameras = cam_count()
+            self.set_worker_count(DEFAULT_WORKERS)
+            print(f"{self.num_cameras} cameras found")
         else:
             self.num_cameras = 0
             print(f"Failed to find cameras, please check connections")
 
     def end(self):
-        self.cameras.end()
+        self.stop_capture()
+        self.stop_recording()
+        self.stop_session_log()
+        self.set_worker_count(1)
+        if self.capture_state >= States.CamerasFound:
+            self.cameras.end()
+
+    def set_camera_source(self, source):
+        """
+        Replaces the cameras with `source`, anything with pseyepy's
+        `read(squeeze=False)`, `end()` and a `num_cameras` attribute, e.g. a
+        ReplayCamera. Capture restarts if it was running.
+
+        """
+        was_capturing = self.is_capturing
+        self.stop_capture()
+        if self.capture_state >= States.CamerasFound:
+            self.cameras.end()
+
+        self.cameras = source
+        self.num_cameras = source.num_cameras
+        # Sources may bring their own intrinsics, e.g. simulated cameras
+        self.intrinsic_matrices = getattr(source, "intrinsic_matrices", intrinsic_matrices)
+        self.distortion_coefs = getattr(source, "distortion_coefs", distortion_coefs)
+        self.target_fps = getattr(source, "fps", DEFAULT_FPS)
+        self.capture_state = States.ImageProcessing
+        self.set_worker_count(DEFAULT_WORKERS)
+        self.undistort_cache.clear()
+        self._roi_points = None
+        self._last_read_time = None
+        self._last_timestamp = None
+        self._jpeg_cache = {}
+        print(f"{self.num_cameras} cameras from {type(source).__name__}")
+
+        if self.socketio is not None:
+            self.socketio.emit("num-cams", self.num_cameras)
+        if was_capturing:
+            self.start_capture()
+
+    def start_recording(self, path):
+        if self.frame_recorder is not None:
+            raise RuntimeError(f"Already recording to {self.frame_recorder.path}")
+        self.frame_recorder = FrameRecorder(path)
+
+    def stop_recording(self):
+        if self.frame_recorder is None:
+            return None
+        frame_recorder = self.frame_recorder
+        self.frame_recorder = None
+        frame_recorder.close()
+        return frame_recorder
+
+    def start_session_log(self, path):
+        if self.session_logger is not None:
+            raise RuntimeError(f"Already logging to {self.session_logger.path}")
+        self.session_logger = SessionLogger(path)
+
+    def stop_session_log(self):
+        if self.session_logger is None:
+            return None
+        session_logger = self.session_logger
+        self.session_logger = None
+        session_logger.close()
+        return session_logger
+
+    def set_worker_count(self, worker_count):
+        if worker_count is None:
+            worker_count = self.num_cameras
+        if self.worker_pool is not None:
+            self.worker_pool.shutdown()
+            self.worker_pool = None
+        if worker_count > 1:
+            self.worker_pool = ThreadPoolExecutor(
+                max_workers=worker_count, thread_name_prefix="camera-worker"
+            )
+
+    def _map_cameras(self, function, frames):
+        # Runs function(camera_index, frame) for every camera and waits for all of them
+        if self.worker_pool is None:
+            return [function(i, frames[i]) for i in range(0, self.num_cameras)]
+        return list(self.worker_pool.map(function, range(0, self.num_cameras), frames))
+
+    def start_capture(self):
+        if self.capture_thread is not None and self.capture_thread.is_alive():
+            return
+        if self.capture_state < States.CamerasFound:
+            return
+        self.is_capturing = True
+        self.capture_error = None
+        self.capture_thread = threading.Thread(target=self._capture_loop, daemon=True)
+        self.capture_thread.start()
+
+    def stop_capture(self):
+        self.is_capturing = False
+        if self.capture_thread is not None:
+            self.capture_thread.join()
+            self.capture_thread = None
+
+    def _capture_loop(self):
+        last_fps_time = time.time()
+        frame_count = 0
+        failures = 0
+
+        while self.is_capturing:
+            try:
+                frames = self._camera_read()
+            except EOFError:
+                # A replay without loop reached its end
+                print("Camera source finished, stopping capture")
+                self.is_capturing = False
+                self._emit("success", "Replay finished")
+                break
+            except Exception as e:
+                traceback.print_exc()
+                self.dropped_frames.labels("error").inc()
+                failures += 1
+                if failures >= MAX_CAPTURE_FAILURES:
+                    self.capture_error = f"Capture stopped after {failures} failed frames: {e}"
+                    print(self.capture_error)
+                    self.is_capturing = False
+                    self._emit("error", self.capture_error)
+                    break
+                time.sleep(min(CAPTURE_RETRY_DELAY * 2 ** (failures - 1), MAX_CAPTURE_RETRY_DELAY))
+                continue
+            failures = 0
+            self.frame_buffer.publish(frames)
+
+            frame_count += 1
+            if frame_count == FPS_AVERAGE_FRAMES:
+                time_now = time.time()
+                self._publish(
+                    Channels.Fps,
+                    "fps",
+                    {
+                        "fps": round(frame_count / (time_now - last_fps_time)),
+                        "stage_timings": self.stage_timings,
+                    },
+                )
+                last_fps_time = time_now
+                frame_count = 0
+
+    def subscribe(self):
+        return self.frame_buffer.subscribe()
 
     # TODO - Method deprecated, remove from frontend, rename capture_state to just state
     def state(self):
@@ -60,61 +346,155 @@ class Cameras:
             "is_capturing_points": self.capture_state >= States.PointCapture,
             "is_triangulating_points": self.capture_state >= States.Triangulation,
             "is_locating_objects": self.capture_state >= States.ObjectDetection,
+            "capture_error": self.capture_error,
         }
 
     def set_socketio(self, socketio):
+        # Called by every camera stream request, keep the clients' subscriptions
+        if self.socket_channels is None or self.socketio is not socketio:
+            self.socket_channels = SocketChannels(socketio)
         self.socketio = socketio
         self.socketio.emit("num-cams", self.num_cameras)
 
     def set_camera_poses(self, poses):
         self.camera_poses = poses
-        p = []
-        for i, camera_pose in enumerate(self.camera_poses):
-            RT = np.c_[camera_pose["R"], camera_pose["t"]]
-            P = intrinsic_matrices[i] @ RT
-            p.append(P)
-        self.projection_matrices = p
+        self.calibration = Calibration(poses, self.intrinsic_matrices)
+        self.projection_matrices = self.calibration.projection_matrices
+
+    def set_processing_mode(self, processing_mode):
+        if processing_mode not in [ProcessingModes.FullFrame, ProcessingModes.PointsOnly]:
+            raise RuntimeError(f"Unknown processing mode {processing_mode}")
+        self.processing_mode = processing_mode
+
+    def set_overlay_mode(self, overlay_mode):
+        if overlay_mode not in [OverlayModes.Auto, OverlayModes.Always, OverlayModes.Never]:
+            raise RuntimeError(f"Unknown overlay mode {overlay_mode}")
+        self.overlay_mode = overlay_mode
+
+    def _should_draw_overlays(self):
+        if self.overlay_mode == OverlayModes.Auto:
+            return self.frame_buffer.subscriber_count() > 0
+        return self.overlay_mode == OverlayModes.Always
+
+    def set_rigid_bodies(self, rigid_bodies):
+        self.rigid_bodies = RigidBodyRegistry(rigid_bodies)
+        self.kalman_filter.reset()
+
+    def start_roi_tracking(self):
+        self.roi_tracking = True
+
+    def stop_roi_tracking(self):
+        self.roi_tracking = False
+        self._roi_points = None
+
+    def _is_points_only(self):
+        return (
+            self.processing_mode == ProcessingModes.PointsOnly
+            and self.capture_state >= States.PointCapture
+        )
 
     def edit_settings(self, exposure, gain):
         self.cameras.exposure = [exposure] * self.num_cameras
         self.cameras.gain = [gain] * self.num_cameras
 
     def _camera_read(self):
+        timings = {}
+        frame_start = stage_start = time.perf_counter()
+
         frames, timestamps = self.cameras.read(squeeze=False)
+        frame_recorder = self.frame_recorder
+        if frame_recorder is not None and not frame_recorder.write(frames, timestamps):
+            self.dropped_frames.labels("recorder").inc()
+        self._count_missed_frames(timestamps)
+        if self._last_read_time is not None:
+            self._frame_interval = stage_start - self._last_read_time
+        self._last_read_time = stage_start
         image_points = []
         object_points = []
         errors = []
         objects = []
         filtered_objects = []
+        draw_overlays = self._should_draw_overlays()
+        stage_start = self._record_stage(timings, "read", stage_start)
 
         if self.capture_state == States.SaveImage:
             self._capture_image(frames)
             self.exit_save_image()
 
-        if self.capture_state >= States.ImageProcessing:
+        if self.capture_state >= States.ImageProcessing and not self._is_points_only():
             frames = self._image_processing(frames)
+            stage_start = self._record_stage(timings, "image_processing", stage_start)
         
         if self.capture_state >= States.PointCapture:
-            image_points = self._point_capture(frames)
+            image_points = self._point_capture(frames, draw_overlays, self._roi_windows(frames))
+            stage_start = self._record_stage(timings, "point_capture", stage_start)
 
         if self.capture_state >= States.Triangulation:
-            errors, object_points, frames = self._triangulation(frames, image_points)
+            correspondances, visibility = self._correspondance(frames, image_points, draw_overlays)
+            stage_start = self._record_stage(timings, "correspondance", stage_start)
+            errors, object_points = self._triangulation(correspondances, visibility)
+            stage_start = self._record_stage(timings, "triangulation", stage_start)
 
         if self.capture_state >= States.ObjectDetection:
             objects, filtered_objects = self._object_detection(object_points, errors)
+            self._update_roi_points(object_points, filtered_objects)
+            stage_start = self._record_stage(timings, "object_detection", stage_start)
 
         average_time = np.mean(timestamps)
+        session_logger = self.session_logger
+        if (
+            session_logger is not None
+            and self.capture_state >= States.Triangulation
+            and not session_logger.log(average_time, object_points, errors, objects, filtered_objects)
+        ):
+            self.dropped_frames.labels("session_log").inc()
         self._emit_data(average_time, image_points, object_points, errors, objects, filtered_objects)
+        stage_end = self._record_stage(timings, "emit", stage_start)
+
+        self.stage_timings = timings
+        self.frame_duration.observe(stage_end - frame_start)
+        self.frames_processed.inc()
+        self.object_points.set(len(object_points))
         return frames
 
-    def get_frames(self, camera=None):
-        if self.capture_state >= States.CamerasFound:
-            frames = self._camera_read()
-            if camera == None:
-                return np.hstack(frames)
-            return frames[camera]
-        else:
-            raise RuntimeError("Cannot get frames state is {self.capture_state}, should be greater than {States.CameraFound}")
+    def _record_stage(self, timings, stage, stage_start):
+        stage_end = time.perf_counter()
+        timings[stage] = round((stage_end - stage_start) * 1000, 3)
+        self.stage_duration.labels(stage).observe(stage_end - stage_start)
+        return stage_end
+
+    def _count_missed_frames(self, timestamps):
+        # Frames the cameras captured while the pipeline was busy show up as
+        # gaps of more than one frame between timestamps
+        timestamp = np.mean(timestamps)
+        if self._last_timestamp is not None:
+            missed = round((timestamp - self._last_timestamp) * self.target_fps) - 1
+            if missed > 0:
+                self.dropped_frames.labels("camera").inc(missed)
+        self._last_timestamp = timestamp
+
+    def get_frames(self, subscription, camera=None, timeout=1.0):
+        if self.capture_state < States.CamerasFound:
+            raise RuntimeError(f"Cannot get frames state is {self.capture_state}, should be greater than {States.CamerasFound}")
+        sequence, frames = subscription.next(timeout)
+        if frames is None:
+            return sequence, None
+        if camera == None:
+            return sequence, np.hstack(frames)
+        return sequence, frames[camera]
+
+    def get_jpeg(self, subscription, camera=None, timeout=1.0):
+        # Encode each published frame once per view, however many streams are open
+        sequence, frame = self.get_frames(subscription, camera, timeout)
+        if frame is None:
+            return None
+        with self._jpeg_lock:
+            if self._jpeg_sequence != sequence:
+                self._jpeg_sequence = sequence
+                self._jpeg_cache = {}
+            if camera not in self._jpeg_cache:
+                self._jpeg_cache[camera] = cv.imencode(".jpg", frame)[1].tobytes()
+            return self._jpeg_cache[camera]
 
     def _capture_image(self, frames):
         for i in range(0, self.num_cameras):
@@ -122,88 +502,189 @@ class Cameras:
             cv.imwrite(f"./images/camera_{i}_{uuid.uuid4()}.jpg", frames[i])
 
     def _image_processing(self, frames):
-        for i in range(0, self.num_cameras):
-            frames[i] = np.rot90(frames[i], k=0)
-            frames[i] = make_square(frames[i])
-            frames[i] = cv.undistort(frames[i], intrinsic_matrices[i], distortion_coefs[i])
-            # frames[i] = cv.medianBlur(frames[i],9)
-            # frames[i] = cv.GaussianBlur(frames[i],(9,9),0)
-            kernel = np.array(
-                [
-                    [-2, -1, -1, -1, -2],
-                    [-1,  1,  3,  1, -1],
-                    [-1,  3,  4,  3, -1],
-                    [-1,  1,  3,  1, -1],
-                    [-2, -1, -1, -1, -2],
-                ]
-            )
-            frames[i] = cv.filter2D(frames[i], -1, kernel)
-            frames[i] = cv.cvtColor(frames[i], cv.COLOR_RGB2BGR)
-        return frames
+        return self._map_cameras(self._process_image, frames)
+
+    def _process_image(self, i, frame):
+        frame = np.rot90(frame, k=0)
+        frame = make_square(frame)
+        frame = self.undistort_cache.undistort(
+            i, frame, self.intrinsic_matrices[i], self.distortion_coefs[i]
+        )
+        # frame = cv.medianBlur(frame,9)
+        # frame = cv.GaussianBlur(frame,(9,9),0)
+        frame = cv.filter2D(frame, -1, SHARPEN_KERNEL)
+        frame = cv.cvtColor(frame, cv.COLOR_RGB2BGR)
+        return frame
+
+    def _point_capture(self, frames, draw_overlays=True, roi_windows=None):
+        if roi_windows is None:
+            self._frames_since_full_scan = 0
+            roi_windows = [None] * self.num_cameras
+        else:
+            self._frames_since_full_scan += 1
 
-    def _point_capture(self, frames):
+        results = self._map_cameras(
+            lambda i, frame: self._capture_points(i, frame, draw_overlays, roi_windows[i]), frames
+        )
         image_points = []
-        for i in range(0, self.num_cameras):
-            frames[i], single_camera_image_points = self._find_dot(frames[i])
+        self._roi_marker_lost = False
+        for i, (frame, single_camera_image_points, marker_lost) in enumerate(results):
+            frames[i] = frame
             image_points.append(single_camera_image_points)
+            self._roi_marker_lost = self._roi_marker_lost or marker_lost
+            num_blobs = sum(1 for point in single_camera_image_points if point[0] is not None)
+            self.blobs.labels(i).set(num_blobs)
+            self.blobs_found.labels(i).inc(num_blobs)
         return image_points
 
-    def _find_dot(self, img):
+    def _capture_points(self, i, frame, draw_overlays=True, windows=None):
+        frame, image_points, marker_lost = self._find_dot(frame, draw_overlays, windows)
+        if self._is_points_only() and image_points[0][0] is not None:
+            image_points = undistort_image_points(
+                image_points,
+                frame.shape,
+                self.intrinsic_matrices[i],
+                self.distortion_coefs[i],
+            ).tolist()
+        return frame, image_points, marker_lost
+
+    def _find_dot(self, img, draw_overlays=True, windows=None):
         # img = cv.GaussianBlur(img,(5,5),0)
         grey = cv.cvtColor(img, cv.COLOR_RGB2GRAY)
-        grey = cv.threshold(grey, 255 * 0.2, 255, cv.THRESH_BINARY)[1]
-        contours, _ = cv.findContours(grey, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
-        img = cv.drawContours(img, contours, -1, (0, 255, 0), 1)
-
-        image_points = []
-        for contour in contours:
-            moments = cv.moments(contour)
-            if moments["m00"] != 0:
-                center_x = int(moments["m10"] / moments["m00"])
-                center_y = int(moments["m01"] / moments["m00"])
+        marker_lost = False
+        if windows is None:
+            centroids, areas, _ = find_blobs(grey, 255 * 0.2)
+        else:
+            # Only scan the windows, a window with no dot in it means a marker
+            # was lost and the next frame falls back to a full scan
+            all_centroids = [np.empty((0, 2), dtype=np.float32)]
+            all_areas = [np.empty(0, dtype=np.int32)]
+            for x0, y0, x1, y1 in windows:
+                window_centroids, window_areas, _ = find_blobs(grey[y0:y1, x0:x1], 255 * 0.2)
+                marker_lost = marker_lost or len(window_centroids) == 0
+                all_centroids.append(window_centroids + np.array([x0, y0], dtype=np.float32))
+                all_areas.append(window_areas)
+                if draw_overlays:
+                    cv.rectangle(img, (x0, y0), (x1 - 1, y1 - 1), (255, 100, 0), 1)
+            centroids = np.concatenate(all_centroids)
+            areas = np.concatenate(all_areas)
+
+        if draw_overlays:
+            for (center_x, center_y), area in zip(centroids, areas):
+                center = (int(round(center_x)), int(round(center_y)))
+                radius = int(np.ceil(np.sqrt(area / np.pi))) + 1
+                cv.circle(img, center, radius, (0, 255, 0), 1)
                 cv.putText(
                     img,
-                    f"({center_x}, {center_y})",
-                    (center_x, center_y - 15),
+                    f"({center_x:.1f}, {center_y:.1f})",
+                    (center[0], center[1] - 15),
                     cv.FONT_HERSHEY_SIMPLEX,
                     0.3,
                     (100, 255, 100),
                     1,
                 )
-                cv.circle(img, (center_x, center_y), 1, (100, 255, 100), -1)
-                image_points.append([center_x, center_y])
+                cv.circle(img, center, 1, (100, 255, 100), -1)
 
+        image_points = centroids.tolist()
         if len(image_points) == 0:
             image_points = [[None, None]]
 
-        return img, image_points
+        return img, image_points, marker_lost
+
+    def _roi_windows(self, frames):
+        # Returns the windows to scan in each camera, or None for a full frame scan
+        if (
+            not self.roi_tracking
+            or self.capture_state < States.ObjectDetection
+            or self._roi_points is None
+            or self._roi_marker_lost
+            or self._frames_since_full_scan >= self.roi_full_scan_interval
+        ):
+            return None
+
+        points_only = self._is_points_only()
+        camera_points = self._from_world_coords(self._roi_points)
+        roi_windows = []
+        for i in range(0, self.num_cameras):
+            R = self.calibration.camera_poses[i]["R"]
+            t = self.calibration.camera_poses[i]["t"]
+            in_front = (R @ camera_points.T + t)[2] > 0
+            if not np.any(in_front):
+                return None
+
+            # Raw frames are distorted and not yet squared, processed frames are neither
+            projected_points, _ = cv.projectPoints(
+                camera_points[in_front],
+                cv.Rodrigues(R)[0],
+                t,
+                self.intrinsic_matrices[i],
+                self.distortion_coefs[i] if points_only else None,
+            )
+            projected_points = projected_points[:, 0, :]
+            if points_only:
+                projected_points -= square_offset(frames[i].shape)
+
+            height, width = frames[i].shape[:2]
+            windows = []
+            for x, y in projected_points:
+                x0, y0 = max(int(x) - self.roi_radius, 0), max(int(y) - self.roi_radius, 0)
+                x1, y1 = min(int(x) + self.roi_radius + 1, width), min(int(y) + self.roi_radius + 1, height)
+                if x0 < x1 and y0 < y1:
+                    windows.append((x0, y0, x1, y1))
+            if len(windows) == 0:
+                return None
+            roi_windows.append(merge_windows(windows))
+
+        return roi_windows
+
+    def _update_roi_points(self, object_points, filtered_objects):
+        if not self.roi_tracking or len(filtered_objects) == 0:
+            self._roi_points = None
+            return
 
+        # Markers seen this frame plus where the tracker expects each object to be next frame
+        predicted_points = [
+            np.array(filtered_object["pos"]) + np.array(filtered_object["vel"]) * self._frame_interval
+            for filtered_object in filtered_objects
+        ]
+        self._roi_points = np.concatenate(
+            [np.reshape(object_points, (-1, 3)), np.reshape(predicted_points, (-1, 3))]
+        )
 
-    def _triangulation(self, frames, image_points):
-        errors, object_points, frames = (
-            find_point_correspondance_and_object_points(
-                image_points, self.camera_poses, frames
-            )
+    def _correspondance(self, frames, image_points, draw_overlays=True):
+        stats = {}
+        correspondances = find_point_correspondances(
+            image_points,
+            self.calibration,
+            frames if draw_overlays else None,
+            self.max_correspondance_hypotheses,
+            stats=stats,
         )
-        # convert to world coordinates
-        for i, object_point in enumerate(object_points):
-            new_object_point = (
-                np.array([[-1, 0, 0], [0, -1, 0], [0, 0, 1]]) @ object_point
-            )
-            new_object_point = np.concatenate((new_object_point, [1]))
-            new_object_point = (
-                np.array(self.to_world_coords_matrix) @ new_object_point
-            )
-            new_object_point = new_object_point[:3] / new_object_point[3]
-            new_object_point[1], new_object_point[2] = (
-                new_object_point[2],
-                new_object_point[1],
-            )
-            object_points[i] = new_object_point
-        return object_points, errors, frames
+        self.correspondance_hypotheses.inc(stats["hypotheses"])
+        return correspondances
+
+    def _triangulation(self, correspondances, visibility):
+        Ps = self.calibration.projection_matrices
+        object_points = triangulate_points_batch(correspondances, visibility, Ps)
+        _, errors = reprojection_errors_batch(object_points, correspondances, visibility, Ps)
+        object_points = self._to_world_coords(object_points)
+        return errors, object_points
+
+    def _to_world_coords(self, object_points):
+        points = np.reshape(np.asarray(object_points, dtype=np.float64), (-1, 3))
+        points = points * [-1, -1, 1]
+        points = np.c_[points, np.ones(len(points))] @ np.array(self.to_world_coords_matrix).T
+        points = points[:, :3] / points[:, 3:]
+        return points[:, [0, 2, 1]]
+
+    def _from_world_coords(self, world_points):
+        points = np.reshape(np.asarray(world_points, dtype=np.float64), (-1, 3))[:, [0, 2, 1]]
+        points = np.c_[points, np.ones(len(points))] @ np.linalg.inv(self.to_world_coords_matrix).T
+        points = points[:, :3] / points[:, 3:]
+        return points * [-1, -1, 1]
 
     def _object_detection(self, object_points, errors):
-        objects = locate_objects(object_points, errors)
+        objects = locate_objects(object_points, errors, self.rigid_bodies)
         filtered_objects = self.kalman_filter.predict_location(objects)
 
         if len(filtered_objects) != 0:
@@ -215,30 +696,26 @@ class Cameras:
         for filtered_object in filtered_objects:
             filtered_object["vel"] = filtered_object["vel"].tolist()
             filtered_object["pos"] = filtered_object["pos"].tolist()
+            if "quaternion" in filtered_object:
+                filtered_object["quaternion"] = filtered_object["quaternion"].tolist()
         return objects, filtered_objects
 
+    def _emit(self, event, data):
+        if self.socketio is not None:
+            self.socketio.emit(event, data)
+
+    def _publish(self, channel, event, data):
+        if self.socket_channels is not None:
+            self.socket_channels.publish(channel, event, data)
+
     def _emit_data(self, time, image_points, object_points, errors, objects, filtered_objects):
         # TODO - Use only one message, front end can figure out shape based on capture state
         if any(np.all(point[0] != [None, None]) for point in image_points):
             if self.capture_state == States.PointCapture:
-                self.socketio.emit("image-points", [x[0] for x in image_points])
-            elif self.capture_state >= States.Triangulation:
-                self.socketio.emit(
-                    "object-points",
-                    {
-                        "object_points": object_points.tolist(),
-                        "time_ms": time, 
-                        "image_points": image_points,
-                        "errors": errors.tolist(),
-                        "objects": [
-                            {
-                                k: (v.tolist() if isinstance(v, np.ndarray) else v)
-                                for (k, v) in object.items()
-                            }
-                            for object in objects
-                        ],
-                        "filtered_objects": filtered_objects,
-                    },
+                self._publish(Channels.ImagePoints, "image-points", [x[0] for x in image_points])
+            elif self.capture_state >= States.Triangulation and self.socket_channels is not None:
+                self.socket_channels.publish_object_points(
+                    time, image_points, object_points, errors, objects, filtered_objects
                 )
 
     # State change functions 
@@ -261,24 +738,28 @@ class Cameras:
         self._state_change(States.ImageProcessing, [States.PointCapture])
 
     def start_triangulating_points(self, camera_poses):
-        self.camera_poses = camera_poses
+        self.set_camera_poses(camera_poses)
         self._state_change(States.Triangulation, [States.PointCapture])
         
     def stop_triangulating_points(self):
         self._state_change(States.PointCapture, [States.Triangulation])
         self.camera_poses = None
+        self.calibration = None
+        self.projection_matrices = None
 
     def start_object_detection(self):
         self._state_change(States.ObjectDetection, [States.Triangulation])
+        self.kalman_filter.reset()
     
     def stop_object_detection(self):
         self._state_change(States.Triangulation, [States.ObjectDetection])
+        self.kalman_filter.reset()
 
     def start_locating_objects(self):
-        self.is_locating_objects = True
+        self.start_object_detection()
 
     def stop_locating_objects(self):
-        self.is_locating_objects = False
+        self.stop_object_detection()
 
     def _state_change(self, target_state, valid_source_states):
         if self.capture_state in valid_source_states:
@@ -1,373 +1,578 @@
 import numpy as np
-from scipy import linalg, optimize
+from scipy import optimize, sparse
 import cv2 as cv
 from scipy.spatial.transform import Rotation
-import copy
 import numpy as np
 from settings import intrinsic_matrices
+from RigidBodies import RigidBodyRegistry
 
 
-def calculate_reprojection_errors(image_points, object_points, camera_poses):
-    errors = np.array([])
-    for image_points_i, object_point in zip(image_points, object_points):
-        error = calculate_reprojection_error(image_points_i, object_point, camera_poses)
-        if error is None:
-            continue
-        errors = np.concatenate([errors, [error]])
+# Points seen by fewer than two cameras are skipped
+def calculate_reprojection_errors(image_points, object_points, camera_poses, projection_matrices=None):
+    if projection_matrices is None:
+        projection_matrices = camera_poses_to_projection_matrices(camera_poses)
+    if len(image_points) == 0:
+        return np.array([])
 
-    return errors
+    image_points, visibility = image_points_to_array(image_points)
+    object_points = np.array(object_points, dtype=np.float64).reshape((-1, 3))
+    _, errors = reprojection_errors_batch(object_points, image_points, visibility, projection_matrices)
 
+    return errors[~np.isnan(errors)]
 
-def calculate_reprojection_error(image_points, object_point, camera_poses):
-    image_points = np.array(image_points)
-    none_indicies = np.where(np.all(image_points == None, axis=1))[0]
-    image_points = np.delete(image_points, none_indicies, axis=0)
-    camera_poses = np.delete(camera_poses, none_indicies, axis=0)
 
-    if len(image_points) <= 1:
+def calculate_reprojection_error(image_points, object_point, camera_poses, projection_matrices=None):
+    errors = calculate_reprojection_errors([image_points], [object_point], camera_poses, projection_matrices)
+    if len(errors) == 0:
         return None
 
-    image_points_t = image_points.transpose((0, 1))
+    return errors[0]
 
-    errors = np.array([])
-    for i, camera_pose in enumerate(camera_poses):
-        if np.all(image_points[i] == None, axis=0):
-            continue
-        projected_img_points, _ = cv.projectPoints(
-            np.expand_dims(object_point, axis=0).astype(np.float32),
-            np.array(camera_pose["R"], dtype=np.float64),
-            np.array(camera_pose["t"], dtype=np.float64),
-            intrinsic_matrices[i],
-            np.array([]),
-        )
-        projected_img_point = projected_img_points[:, 0, :][0]
-        errors = np.concatenate(
-            [errors, (image_points_t[i] - projected_img_point).flatten() ** 2]
-        )
 
-    return errors.mean()
+# Projects every object point into every camera with a single matrix multiply.
+# Returns the (points, cameras) mean squared x/y error of each observation, nan
+# where the camera didn't see the point, and the (points,) mean of those over
+# the cameras that did, nan for points seen by fewer than two cameras
+def reprojection_errors_batch(object_points, image_points, visibility, projection_matrices):
+    Ps = np.asarray(projection_matrices, dtype=np.float64)
+    object_points = np.c_[object_points, np.ones(len(object_points))]
 
+    projected_points = np.einsum("cij,nj->nci", Ps, object_points)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        projected_points = projected_points[..., 0:2] / projected_points[..., 2, np.newaxis]
 
-# https://www.cs.jhu.edu/~misha/ReadingSeminar/Papers/Triggs00.pdf
-# original bundle adjustment, specifies focal length as an adjustment
-# which seems like a mistake since its not used in the residual function
-def bundle_adjustment(image_points, camera_poses):
+    observation_errors = np.mean((image_points - projected_points) ** 2, axis=2)
+    observation_errors[~visibility] = np.nan
 
-    def params_to_camera_poses(params):
-        focal_distances = []
-        num_cameras = int((params.size - 1) / 7) + 1
-        camera_poses = [{"R": np.eye(3), "t": np.array([0, 0, 0], dtype=np.float32)}]
-        focal_distances.append(params[0])
-        for i in range(0, num_cameras - 1):
-            focal_distances.append(params[i * 7 + 1])
-            camera_poses.append(
-                {
-                    "R": Rotation.as_matrix(
-                        Rotation.from_rotvec(params[i * 7 + 2 : i * 7 + 3 + 2])
-                    ),
-                    "t": params[i * 7 + 3 + 2 : i * 7 + 6 + 2],
-                }
-            )
+    num_observations = np.sum(visibility, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        point_errors = np.sum(np.where(visibility, observation_errors, 0), axis=1) / num_observations
+    point_errors[num_observations <= 1] = np.nan
 
-        return camera_poses, focal_distances
+    return observation_errors, point_errors
 
-    def residual_function(params):
-        camera_poses, focal_distances = params_to_camera_poses(params)
-        object_points = triangulate_points(image_points, camera_poses)
-        errors = calculate_reprojection_errors(
-            image_points, object_points, camera_poses
+
+# Initial camera poses from the essential matrix between each consecutive pair
+# of cameras, chaining from camera 0 at the origin. Of the four possible
+# motions, the one with the most points in front of both cameras is kept
+def initial_camera_poses(image_points):
+    image_points = np.array(image_points)
+    image_points_t = image_points.transpose((1, 0, 2))
+
+    camera_poses = [{"R": np.eye(3), "t": np.array([[0], [0], [0]], dtype=np.float32)}]
+    for camera_i in range(0, image_points.shape[1] - 1):
+        camera1_image_points = image_points_t[camera_i]
+        camera2_image_points = image_points_t[camera_i + 1]
+        not_none_indicies = np.where(
+            np.all(camera1_image_points != None, axis=1)
+            & np.all(camera2_image_points != None, axis=1)
+        )[0]
+        camera1_image_points = np.take(
+            camera1_image_points, not_none_indicies, axis=0
+        ).astype(np.float32)
+        camera2_image_points = np.take(
+            camera2_image_points, not_none_indicies, axis=0
+        ).astype(np.float32)
+
+        F, _ = cv.findFundamentalMat(
+            camera1_image_points, camera2_image_points, cv.FM_RANSAC, 3, 0.99999
         )
-        errors = errors.astype(np.float32)
-        return errors
-
-    focal_distance = intrinsic_matrices[0][0, 0]
-    init_params = np.array([focal_distance])
-    for i, camera_pose in enumerate(camera_poses[1:]):
-        rot_vec = Rotation.as_rotvec(Rotation.from_matrix(camera_pose["R"])).flatten()
-        focal_distance = intrinsic_matrices[i][0,0]
-        init_params = np.concatenate([init_params, [focal_distance]])
-        init_params = np.concatenate([init_params, rot_vec])
-        init_params = np.concatenate([init_params, np.array(camera_pose["t"]).flatten()])
+        if F is None:
+            raise ValueError("Could not compute fundamental matrix")
+        E = cv.sfm.essentialFromFundamental(
+            F,
+            intrinsic_matrices[camera_i],
+            intrinsic_matrices[camera_i+1]
+        )
+        possible_Rs, possible_ts = cv.sfm.motionFromEssential(E)
+
+        R = None
+        t = None
+        max_points_infront_of_camera = 0
+        for i in range(0, 4):
+            object_points = triangulate_points(
+                np.hstack(
+                    [
+                        np.expand_dims(camera1_image_points, axis=1),
+                        np.expand_dims(camera2_image_points, axis=1),
+                    ]
+                ),
+                np.concatenate(
+                    [[camera_poses[-1]], [{"R": possible_Rs[i], "t": possible_ts[i]}]]
+                ),
+            )
+            object_points_camera_coordinate_frame = np.array(
+                [possible_Rs[i].T @ object_point for object_point in object_points]
+            )
 
-    res = optimize.least_squares(
-        residual_function, init_params, verbose=2, loss="linear", ftol=1e-9
-    )
-    
-    return params_to_camera_poses(res.x)[0]
+            points_infront_of_camera = np.sum(object_points[:, 2] > 0) + np.sum(
+                object_points_camera_coordinate_frame[:, 2] > 0
+            )
 
-# a much dumber bundle adjustment that just does rotation adjustments
-# hope is that this improves accuracy by assuming distances can be pretty well
-# calibrated manually
-def bundle_adjustment2(image_points, camera_poses):
+            if points_infront_of_camera > max_points_infront_of_camera:
+                max_points_infront_of_camera = points_infront_of_camera
+                R = possible_Rs[i]
+                t = possible_ts[i]
+
+        R = R @ camera_poses[-1]["R"]
+        t = camera_poses[-1]["t"] + (camera_poses[-1]["R"] @ t)
+
+        camera_poses.append({"R": R, "t": t})
+
+    return camera_poses
 
-    def params_to_camera_poses(params):
-        for i, _ in enumerate(camera_poses):
-            start = i * 3
-            end = i * 3 + 3
-            camera_poses[i]["R"] = Rotation.as_matrix(
-                Rotation.from_rotvec(params[start:end])
-            )
 
-        return camera_poses
+GAUGE_WEIGHT = 1000.0
+
+# Joint bundle adjustment of camera poses and object points
+# https://scipy-cookbook.readthedocs.io/items/bundle_adjustment.html
+# Each observation only depends on one camera's pose and one object point, so
+# the Jacobian is sparse. Its blocks come analytically from cv.projectPoints,
+# and a robust loss keeps mismatched points from dragging the solution around.
+# Camera 0 is held at the origin and, as scale is unobservable, an extra
+# residual holds the distance to camera 1 at its initial value. Returns the
+# refined camera poses, object points, reprojection error statistics for each
+# camera and a summary of the solve, whose "converged" is False if it stopped
+# at `max_nfev` evaluations. `callback(iteration, cost, mean_error)` is called
+# after every accepted step, raising from it aborts the solve
+def sparse_bundle_adjustment(image_points, camera_poses, loss="soft_l1", f_scale=2.0, max_nfev=500, callback=None):
+    image_points, visibility = image_points_to_array(image_points)
+    seen_by_multiple_cameras = np.sum(visibility, axis=1) >= 2
+    image_points = image_points[seen_by_multiple_cameras]
+    visibility = visibility[seen_by_multiple_cameras]
+
+    num_cameras = len(camera_poses)
+    num_points = len(image_points)
+    camera_params_size = (num_cameras - 1) * 6
+    point_indicies, camera_indicies = np.nonzero(visibility)
+    observed_points = image_points[point_indicies, camera_indicies]
+    observation_indicies = [np.flatnonzero(camera_indicies == i) for i in range(0, num_cameras)]
+    num_residuals = 2 * len(observed_points) + 1
+    baseline = 0
+    if num_cameras > 1:
+        baseline = np.linalg.norm(np.array(camera_poses[1]["t"], dtype=np.float64))
+    progress = {"iteration": 0, "residuals": None}
+
+    def params_to_camera_poses(params):
+        rvecs = np.vstack([np.zeros(3), params[:camera_params_size].reshape((-1, 6))[:, 0:3]])
+        tvecs = np.vstack([np.zeros(3), params[:camera_params_size].reshape((-1, 6))[:, 3:6]])
+        object_points = params[camera_params_size:].reshape((num_points, 3))
+        return rvecs, tvecs, object_points
+
+    def project(params, i):
+        rvecs, tvecs, object_points = params_to_camera_poses(params)
+        return cv.projectPoints(
+            object_points[point_indicies[observation_indicies[i]]],
+            rvecs[i],
+            tvecs[i],
+            intrinsic_matrices[i],
+            np.array([]),
+        )
 
     def residual_function(params):
-        camera_poses = params_to_camera_poses(params)
-        object_points = triangulate_points(image_points, camera_poses)
-        errors = calculate_reprojection_errors(
-            image_points, object_points, camera_poses
+        residuals = np.empty((len(observed_points), 2))
+        for i in range(0, num_cameras):
+            if len(observation_indicies[i]) == 0:
+                continue
+            projected_points, _ = project(params, i)
+            residuals[observation_indicies[i]] = (
+                projected_points[:, 0, :] - observed_points[observation_indicies[i]]
+            )
+        gauge_residual = 0
+        if num_cameras > 1:
+            gauge_residual = GAUGE_WEIGHT * (np.linalg.norm(params[3:6]) - baseline)
+        progress["residuals"] = residuals
+        return np.append(residuals.ravel(), gauge_residual)
+
+    def jacobian_function(params):
+        # least_squares evaluates the Jacobian once per accepted step, right
+        # after evaluating the residuals at the same parameters
+        if callback is not None and progress["residuals"] is not None:
+            callback(
+                progress["iteration"],
+                0.5 * float(np.sum(progress["residuals"] ** 2)),
+                float(np.mean(np.linalg.norm(progress["residuals"], axis=1))),
+            )
+        progress["iteration"] += 1
+
+        rows = []
+        cols = []
+        values = []
+        rvecs, _, _ = params_to_camera_poses(params)
+        for i in range(0, num_cameras):
+            observations = observation_indicies[i]
+            if len(observations) == 0:
+                continue
+            _, jacobian = project(params, i)
+            # (observations, 2, 3) derivatives w.r.t. rotation and translation
+            d_rvec = jacobian[:, 0:3].reshape((-1, 2, 3))
+            d_tvec = jacobian[:, 3:6].reshape((-1, 2, 3))
+            # The camera frame point is R @ X + t, so d/dX = d/dt @ R
+            d_point = d_tvec @ cv.Rodrigues(rvecs[i])[0]
+
+            residual_rows = 2 * observations[:, np.newaxis] + np.arange(2)
+            blocks = [(camera_params_size + 3 * point_indicies[observations], d_point)]
+            if i != 0:
+                blocks.append(((i - 1) * 6, d_rvec))
+                blocks.append(((i - 1) * 6 + 3, d_tvec))
+            for col_start, block in blocks:
+                col_start = np.broadcast_to(np.reshape(col_start, (-1, 1, 1)), block.shape)
+                rows.append(np.broadcast_to(residual_rows[:, :, np.newaxis], block.shape).ravel())
+                cols.append((col_start + np.arange(3)).ravel())
+                values.append(block.ravel())
+
+        if num_cameras > 1 and np.linalg.norm(params[3:6]) != 0:
+            rows.append(np.full(3, num_residuals - 1))
+            cols.append(np.arange(3, 6))
+            values.append(GAUGE_WEIGHT * params[3:6] / np.linalg.norm(params[3:6]))
+
+        return sparse.csr_matrix(
+            (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(num_residuals, camera_params_size + 3 * num_points),
         )
-        errors = errors.astype(np.float32)
-        return errors
 
     init_params = []
-    for i, camera_pose in enumerate(camera_poses):
-        rot_vec = Rotation.as_rotvec(Rotation.from_matrix(camera_pose["R"])).flatten()
-        init_params = np.concatenate([init_params, rot_vec])
+    for camera_pose in camera_poses[1:]:
+        init_params.append(cv.Rodrigues(np.array(camera_pose["R"], dtype=np.float64))[0].flatten())
+        init_params.append(np.array(camera_pose["t"], dtype=np.float64).flatten())
+    Ps = camera_poses_to_projection_matrices(camera_poses)
+    init_params.append(triangulate_points_batch(image_points, visibility, Ps).flatten())
+    init_params = np.concatenate(init_params)
+
     res = optimize.least_squares(
-        residual_function, init_params, verbose=2, loss="linear", ftol=1e-9
+        residual_function,
+        init_params,
+        jac=jacobian_function,
+        loss=loss,
+        f_scale=f_scale,
+        x_scale="jac",
+        max_nfev=max_nfev,
+        ftol=1e-6,
+        method="trf",
+        tr_solver="lsmr",
     )
 
-    return camera_poses
-
+    rvecs, tvecs, object_points = params_to_camera_poses(res.x)
+    new_camera_poses = [
+        {"R": cv.Rodrigues(rvecs[i])[0], "t": tvecs[i]} for i in range(0, num_cameras)
+    ]
+
+    observation_errors = np.linalg.norm(res.fun[:-1].reshape((-1, 2)), axis=1)
+    camera_errors = []
+    for i in range(0, num_cameras):
+        errors_i = observation_errors[observation_indicies[i]]
+        camera_errors.append(
+            {
+                "camera": i,
+                "observations": len(errors_i),
+                "mean_error": float(np.mean(errors_i)) if len(errors_i) else None,
+                "rms_error": float(np.sqrt(np.mean(errors_i**2))) if len(errors_i) else None,
+                "max_error": float(np.max(errors_i)) if len(errors_i) else None,
+            }
+        )
 
-def triangulate_point(image_points, camera_poses):
-    image_points = np.array(image_points)
-    none_indicies = np.where(np.all(image_points == None, axis=1))[0]
-    image_points = np.delete(image_points, none_indicies, axis=0)
-    camera_poses = np.delete(camera_poses, none_indicies, axis=0)
+    solve = {"converged": res.status > 0, "evaluations": res.nfev, "message": res.message}
+    return new_camera_poses, object_points, camera_errors, solve
 
-    if len(image_points) <= 1:
-        return [None, None, None]
 
-    Ps = camera_poses_to_projection_matrices(camera_poses)
+def triangulate_point(image_points, camera_poses, projection_matrices=None):
+    return triangulate_points([image_points], camera_poses, projection_matrices)[0]
 
-    object_point = DLT(Ps, image_points)
 
-    return object_point
+# Points seen by fewer than two cameras come back as [nan, nan, nan]
+def triangulate_points(image_points, camera_poses, projection_matrices=None):
+    if projection_matrices is None:
+        projection_matrices = camera_poses_to_projection_matrices(camera_poses)
+    if len(image_points) == 0:
+        return np.empty((0, 3))
 
+    image_points, visibility = image_points_to_array(image_points)
 
-def triangulate_points(image_points, camera_poses):
-    object_points = []
-    for image_points_i in image_points:
-        object_point = triangulate_point(image_points_i, camera_poses)
-        object_points.append(object_point)
+    return triangulate_points_batch(image_points, visibility, projection_matrices)
 
-    return np.array(object_points)
 
-# https://temugeb.github.io/computer_vision/2021/02/06/direct-linear-transorms.html
-def DLT(Ps, image_points):
-    A = []
+# Converts (points, cameras) nested lists where missing observations are
+# [None, None] into a float (points, cameras, 2) array and a visibility mask
+def image_points_to_array(image_points):
+    image_points = np.array(image_points, dtype=np.float64).reshape((len(image_points), -1, 2))
+    visibility = ~np.any(np.isnan(image_points), axis=2)
 
-    for P, image_point in zip(Ps, image_points):
-        A.append(image_point[1] * P[2, :] - P[1, :])
-        A.append(P[0, :] - image_point[0] * P[2, :])
+    return image_points, visibility
 
-    A = np.array(A).reshape((len(Ps) * 2, 4))
-    B = A.transpose() @ A
-    U, s, Vh = linalg.svd(B, full_matrices=False)
-    object_point = Vh[3, 0:3] / Vh[3, 3]
 
-    return object_point
+# Batched version of https://temugeb.github.io/computer_vision/2021/02/06/direct-linear-transorms.html
+# Builds the DLT system of every point at once, masking out the rows of cameras
+# that didn't see it, and solves them all with a single stacked SVD
+def triangulate_points_batch(image_points, visibility, projection_matrices):
+    Ps = np.asarray(projection_matrices, dtype=np.float64)
+    image_points = np.where(visibility[..., np.newaxis], image_points, 0)
+    x = image_points[..., 0, np.newaxis]
+    y = image_points[..., 1, np.newaxis]
 
-def find_point_correspondance_and_object_points(image_points, camera_poses, frames):
-    for image_points_i in image_points:
-        try:
-            image_points_i.remove([None, None])
-        except:
-            pass
+    # (points, cameras, 2, 4), two rows per camera
+    A = np.stack(
+        [
+            y * Ps[np.newaxis, :, 2, :] - Ps[np.newaxis, :, 1, :],
+            Ps[np.newaxis, :, 0, :] - x * Ps[np.newaxis, :, 2, :],
+        ],
+        axis=2,
+    )
+    A = A * visibility[..., np.newaxis, np.newaxis]
+    A = A.reshape((A.shape[0], A.shape[1] * 2, 4))
 
-    # [object_points, possible image_point groups, image_point from camera]
-    correspondances = [[[i]] for i in image_points[0]]
+    B = np.transpose(A, (0, 2, 1)) @ A
+    _, _, Vh = np.linalg.svd(B)
 
-    Ps = camera_poses_to_projection_matrices(camera_poses)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        object_points = Vh[:, 3, 0:3] / Vh[:, 3, 3, np.newaxis]
+    object_points[np.sum(visibility, axis=1) <= 1] = np.nan
 
-    root_image_points = [{"camera": 0, "point": point} for point in image_points[0]]
+    return object_points
 
-    for i in range(1, len(frames)):
-        epipolar_lines = []
-        for root_image_point in root_image_points:
-            F = cv.sfm.fundamentalFromProjections(Ps[root_image_point["camera"]], Ps[i])
-            line = cv.computeCorrespondEpilines(
-                np.array([root_image_point["point"]], dtype=np.float32), 1, F
-            )
-            epipolar_lines.append(line[0, 0].tolist())
-            frames[i] = drawlines(frames[i], line[0])
-
-        not_closest_match_image_points = np.array(image_points[i])
-        points = np.array(image_points[i])
-
-        for j, [a, b, c] in enumerate(epipolar_lines):
-            distances_to_line = np.array([])
-            if len(points) != 0:
-                distances_to_line = np.abs(
-                    a * points[:, 0] + b * points[:, 1] + c
-                ) / np.sqrt(a**2 + b**2)
-
-            possible_matches = points[distances_to_line < 5].copy()
-
-            # Commenting out this code produces more points, but more garbage points too
-            # delete closest match from future consideration
-            # if len(points) != 0:
-            #     points = np.delete(points, np.argmin(distances_to_line), axis=0)
-
-            # sort possible matches from smallest to largest
-            distances_to_line = distances_to_line[distances_to_line < 5]
-            possible_matches_sorter = distances_to_line.argsort()
-            possible_matches = possible_matches[possible_matches_sorter]
-
-            if len(possible_matches) == 0:
-                for possible_group in correspondances[j]:
-                    possible_group.append([None, None])
-            else:
-                not_closest_match_image_points = [
-                    row
-                    for row in not_closest_match_image_points.tolist()
-                    if row != possible_matches.tolist()[0]
-                ]
-                not_closest_match_image_points = np.array(
-                    not_closest_match_image_points
+# Epipolar lines are only drawn onto frames when they are given
+def find_point_correspondance_and_object_points(image_points, calibration, frames=None, max_hypotheses=8):
+    correspondances, visibility = find_point_correspondances(
+        image_points, calibration, frames, max_hypotheses
+    )
+    Ps = calibration.projection_matrices
+    object_points = triangulate_points_batch(correspondances, visibility, Ps)
+    _, errors = reprojection_errors_batch(object_points, correspondances, visibility, Ps)
+
+    return errors, object_points, frames
+
+
+# Groups the image points of every camera into points seen by multiple cameras.
+#
+# Each point in camera 0 starts a group, as does any later point that isn't
+# the closest epipolar match for an existing group. Every camera in turn
+# extends a group's hypotheses with the points near the group's epipolar line
+# in that camera. Hypotheses are pruned by reprojection error to at most
+# max_hypotheses per group, so the cost grows linearly with the number of
+# markers instead of multiplying per camera. Finally the best hypotheses are
+# assigned greedily, lowest reprojection error first, so that no image point
+# is used by two groups.
+#
+# Returns the image points of each group as a (groups, cameras, 2) array along
+# with a (groups, cameras) visibility mask
+# `stats`, if given, is filled with the number of hypotheses scored
+def find_point_correspondances(image_points, calibration, frames=None, max_hypotheses=8, epipolar_threshold=5, stats=None):
+    if stats is None:
+        stats = {}
+    stats["hypotheses"] = 0
+    num_cameras = len(image_points)
+    Ps = calibration.projection_matrices
+    camera_points = [
+        np.array(
+            [point for point in image_points_i if point[0] is not None], dtype=np.float64
+        ).reshape((-1, 2))
+        for image_points_i in image_points
+    ]
+
+    # Hypotheses hold the index of the matched point in each camera, -1 if none
+    root_cameras = []
+    root_points = []
+    hypotheses = []
+
+    def add_roots(camera, point_indicies):
+        for point_index in point_indicies:
+            root_cameras.append(camera)
+            root_points.append(camera_points[camera][point_index])
+            hypothesis = np.full((1, num_cameras), -1)
+            hypothesis[0, camera] = point_index
+            hypotheses.append(hypothesis)
+
+    add_roots(0, range(0, len(camera_points[0])))
+
+    for i in range(1, num_cameras):
+        points = camera_points[i]
+        is_closest_match = np.zeros(len(points), dtype=bool)
+
+        if len(root_points) != 0 and len(points) != 0:
+            # Distance of every point in this camera to every group's epipolar line
+            root_cameras_array = np.array(root_cameras)
+            root_points_array = np.array(root_points)
+            epipolar_lines = np.zeros((len(root_points), 3))
+            for root_camera in np.unique(root_cameras_array):
+                is_root_camera = root_cameras_array == root_camera
+                epipolar_lines[is_root_camera] = calibration.epipolar_lines(
+                    root_points_array[is_root_camera], root_camera, i
                 )
-
-                new_correspondances_j = []
-                for possible_match in possible_matches:
-                    temp = copy.deepcopy(correspondances[j])
-                    for possible_group in temp:
-                        possible_group.append(possible_match.tolist())
-                    new_correspondances_j += temp
-                correspondances[j] = new_correspondances_j
-
-        for not_closest_match_image_point in not_closest_match_image_points:
-            root_image_points.append(
-                {"camera": i, "point": not_closest_match_image_point}
-            )
-            temp = [[[None, None]] * i]
-            temp[0].append(not_closest_match_image_point.tolist())
-            correspondances.append(temp)
-
-    object_points = []
-    errors = []
-    for image_points in correspondances:
-        object_points_i = triangulate_points(image_points, camera_poses)
-
-        if np.all(object_points_i == None):
+            if frames is not None:
+                frames[i] = drawlines(frames[i], epipolar_lines)
+
+            distances_to_lines = np.abs(epipolar_lines @ np.c_[points, np.ones(len(points))].T)
+
+            extended_roots = []
+            for j in range(0, len(root_points)):
+                possible_matches = np.flatnonzero(distances_to_lines[j] < epipolar_threshold)
+                if len(possible_matches) == 0:
+                    continue
+                possible_matches = possible_matches[np.argsort(distances_to_lines[j, possible_matches])]
+                is_closest_match[possible_matches[0]] = True
+
+                extended = np.repeat(hypotheses[j], len(possible_matches[:max_hypotheses]), axis=0)
+                extended[:, i] = np.tile(possible_matches[:max_hypotheses], len(hypotheses[j]))
+                hypotheses[j] = extended
+                if len(extended) > max_hypotheses:
+                    extended_roots.append(j)
+
+            # Prune every group that grew past the cap, scoring them all in one batch
+            if len(extended_roots) != 0:
+                errors = _hypothesis_errors(
+                    [hypotheses[j] for j in extended_roots], camera_points, Ps
+                )
+                stats["hypotheses"] += len(errors)
+                error_start = 0
+                for j in extended_roots:
+                    hypothesis_errors = errors[error_start : error_start + len(hypotheses[j])]
+                    error_start += len(hypotheses[j])
+                    best = np.argsort(np.where(np.isnan(hypothesis_errors), np.inf, hypothesis_errors))
+                    hypotheses[j] = hypotheses[j][best[:max_hypotheses]]
+
+        add_roots(i, np.flatnonzero(~is_closest_match))
+
+    if len(hypotheses) == 0:
+        return np.empty((0, num_cameras, 2)), np.empty((0, num_cameras), dtype=bool)
+
+    # Assign hypotheses to groups, best first, never reusing an image point
+    root_indicies = np.concatenate(
+        [np.full(len(hypotheses_j), j) for j, hypotheses_j in enumerate(hypotheses)]
+    )
+    hypotheses = np.concatenate(hypotheses)
+    errors = _hypothesis_errors([hypotheses], camera_points, Ps)
+    stats["hypotheses"] += len(errors)
+
+    is_assigned = np.zeros(len(root_points), dtype=bool)
+    used_points = [np.zeros(len(points), dtype=bool) for points in camera_points]
+    accepted = []
+    for k in np.argsort(errors):
+        if np.isnan(errors[k]):
+            break
+        if is_assigned[root_indicies[k]]:
+            continue
+        observations = [(i, point_index) for i, point_index in enumerate(hypotheses[k]) if point_index != -1]
+        if any(used_points[i][point_index] for i, point_index in observations):
             continue
+        is_assigned[root_indicies[k]] = True
+        for i, point_index in observations:
+            used_points[i][point_index] = True
+        accepted.append(k)
 
-        errors_i = calculate_reprojection_errors(
-            image_points, object_points_i, camera_poses
-        )
+    return _hypotheses_to_image_points(hypotheses[accepted], camera_points)
 
-        object_points.append(object_points_i[np.argmin(errors_i)])
-        errors.append(np.min(errors_i))
 
-    return np.array(errors), np.array(object_points), frames
+def _hypotheses_to_image_points(hypotheses, camera_points):
+    hypotheses = np.reshape(hypotheses, (-1, len(camera_points)))
+    image_points = np.full(hypotheses.shape + (2,), np.nan)
+    visibility = hypotheses != -1
+    for i, points in enumerate(camera_points):
+        image_points[visibility[:, i], i] = points[hypotheses[visibility[:, i], i]]
 
+    return image_points, visibility
 
-def locate_objects(object_points, errors):
-    dist = 0.131
-    dist1 = 0.089
-    dist2 = 0.133
 
-    distance_matrix = np.zeros((object_points.shape[0], object_points.shape[0]))
-    already_matched_points = []
-    objects = []
+def _hypothesis_errors(hypotheses, camera_points, Ps):
+    image_points, visibility = _hypotheses_to_image_points(np.concatenate(hypotheses), camera_points)
+    object_points = triangulate_points_batch(image_points, visibility, Ps[: len(camera_points)])
+    _, errors = reprojection_errors_batch(object_points, image_points, visibility, Ps[: len(camera_points)])
 
-    for i in range(0, object_points.shape[0]):
-        for j in range(0, object_points.shape[0]):
-            distance_matrix[i, j] = np.sqrt(
-                np.sum((object_points[i] - object_points[j]) ** 2)
-            )
-    print("----")
-    print(distance_matrix)
-    print("----")
-    for i in range(0, object_points.shape[0]):
-        if i in already_matched_points:
-            continue
-        matches = np.abs(distance_matrix[i] - dist) < 0.025
-        if np.any(matches):
-            best_match_i = np.argmax(matches)
+    return errors
 
-            already_matched_points.append(i)
-            already_matched_points.append(best_match_i)
 
-            location = (object_points[i]+object_points[best_match_i])/2
-            error = np.mean([errors[i], errors[best_match_i]])
+# Finds the registered rigid bodies among the triangulated points, each object
+# gets its full pose from the matched markers. The poses of all bodies found
+# in the frame are solved together. Bodies whose markers are on one line have
+# no "rotation" or "quaternion", only a heading
+def locate_objects(object_points, errors, rigid_bodies=None):
+    if rigid_bodies is None:
+        rigid_bodies = RigidBodyRegistry()
+
+    object_points = np.asarray(object_points, dtype=np.float64).reshape((-1, 3))
+    errors = np.asarray(errors, dtype=np.float64)
+    matches = rigid_bodies.match(object_points)
+    if len(matches) == 0:
+        return []
+
+    # Bodies with fewer markers are padded with zero weight markers
+    max_markers = max(len(rigid_bodies[body_index].markers) for body_index, _, _ in matches)
+    sources = np.zeros((len(matches), max_markers, 3))
+    targets = np.zeros((len(matches), max_markers, 3))
+    weights = np.zeros((len(matches), max_markers))
+    for i, (body_index, point_indicies, _) in enumerate(matches):
+        num_markers = len(point_indicies)
+        sources[i, :num_markers] = rigid_bodies[body_index].markers
+        targets[i, :num_markers] = object_points[point_indicies]
+        weights[i, :num_markers] = 1
+
+    Rs, ts, _ = rigid_transforms(sources, targets, weights)
+    quaternions = Rotation.from_matrix(Rs).as_quat()
 
-            heading_vec = object_points[best_match_i] - object_points[i]
-            heading_vec /= linalg.norm(heading_vec)
-            heading = np.arctan2(heading_vec[1], heading_vec[0])
+    objects = []
+    for i, (body_index, point_indicies, distance_error) in enumerate(matches):
+        rigid_body = rigid_bodies[body_index]
 
+        # Heading of the body's x axis, a two marker body can't tell its
+        # ends apart so its heading is folded into +-90 degrees
+        heading = np.arctan2(Rs[i, 1, 0], Rs[i, 0, 0])
+        if len(rigid_body.markers) == 2:
             heading = heading - np.pi if heading > np.pi/2 else heading
             heading = heading + np.pi if heading < -np.pi/2 else heading
 
-            objects.append({
-                "pos": location,
-                "heading": -heading,
-                "error": error,
-                "droneIndex": 0
-            })
-        # distance_deltas = np.abs(distance_matrix[i] - dist1)
-        # print(distance_deltas < 0.025)
-        # num_matches = distance_deltas < 0.025
-        
-        # matches_index = np.where(distance_deltas < 0.025)[0]
-        # print("----")
-        # if np.sum(num_matches) >= 2:
-        #     for possible_pair in cartesian_product(matches_index, matches_index):
-        #         pair_distance = np.sqrt(
-        #             np.sum(
-        #                 (
-        #                     object_points[possible_pair[0]]
-        #                     - object_points[possible_pair[1]]
-        #                 )
-        #                 ** 2
-        #             )
-        #         )
-        #         print(pair_distance)
-
-        #         # if the pair isnt the correct distance apart
-        #         if np.abs(pair_distance - dist2) > 0.025:
-        #             continue
-
-        #         best_match_1_i = possible_pair[0]
-        #         best_match_2_i = possible_pair[1]
-
-        #         already_matched_points.append(i)
-        #         already_matched_points.append(best_match_1_i)
-        #         already_matched_points.append(best_match_2_i)
-
-        #         location = (
-        #             object_points[best_match_1_i] + object_points[best_match_2_i]
-        #         ) / 2
-        #         error = np.mean(
-        #             [errors[i], errors[best_match_1_i], errors[best_match_2_i]]
-        #         )
-
-        #         heading_vec = (
-        #             object_points[best_match_1_i] - object_points[best_match_2_i]
-        #         )
-        #         heading_vec /= linalg.norm(heading_vec)
-        #         heading = np.arctan2(heading_vec[1], heading_vec[0])
-
-        #         heading = heading - np.pi if heading > np.pi / 2 else heading
-        #         heading = heading + np.pi if heading < -np.pi / 2 else heading
-
-        #         # determine drone index based on which side third light is on
-        #         drone_index = 0 if (object_points[i] - location)[1] > 0 else 1
-
-        #         objects.append(
-        #             {
-        #                 "pos": location,
-        #                 "heading": -heading,
-        #                 "error": error,
-        #                 "droneIndex": drone_index,
-        #             }
-        #         )
-
-        #         break
+        objects.append({
+            "pos": ts[i],
+            "rotation": Rs[i] if rigid_body.has_orientation else None,
+            "quaternion": quaternions[i] if rigid_body.has_orientation else None,
+            "heading": -heading,
+            "error": np.mean(errors[point_indicies]),
+            "droneIndex": body_index,
+            "name": rigid_body.name,
+        })
 
     return objects
 
 
+# Least squares rotation and translation taking (M, 3) `source` points onto
+# `target` points, `target ~ R @ source + t` (Kabsch)
+def rigid_transform(source, target):
+    Rs, ts, _ = rigid_transforms(source[np.newaxis], target[np.newaxis])
+    return Rs[0], ts[0]
+
+
+# Batched Kabsch/Umeyama, (B, M, 3) `sources` onto `targets` with one stacked
+# SVD. Zero `weights` (B, M) mask out padding points. With `with_scale`
+# the similarity transform `target ~ s * R @ source + t` is solved for
+# instead. Returns (B, 3, 3) rotations, (B, 3) translations and (B,) scales
+def rigid_transforms(sources, targets, weights=None, with_scale=False):
+    sources = np.asarray(sources, dtype=np.float64)
+    targets = np.asarray(targets, dtype=np.float64)
+    if weights is None:
+        weights = np.ones(sources.shape[:2])
+    weights = weights / np.sum(weights, axis=1, keepdims=True)
+
+    source_centroids = np.einsum("bm,bmi->bi", weights, sources)
+    target_centroids = np.einsum("bm,bmi->bi", weights, targets)
+    centered_sources = sources - source_centroids[:, np.newaxis, :]
+    centered_targets = targets - target_centroids[:, np.newaxis, :]
+
+    H = np.einsum("bm,bmi,bmj->bij", weights, centered_sources, centered_targets)
+    U, S, Vt = np.linalg.svd(H)
+    d = np.sign(np.linalg.det(np.transpose(Vt, (0, 2, 1)) @ np.transpose(U, (0, 2, 1))))
+    d[d == 0] = 1
+    D = np.zeros((len(sources), 3, 3))
+    D[:, 0, 0] = 1
+    D[:, 1, 1] = 1
+    D[:, 2, 2] = d
+    Rs = np.transpose(Vt, (0, 2, 1)) @ D @ np.transpose(U, (0, 2, 1))
+
+    scales = np.ones(len(sources))
+    if with_scale:
+        source_variances = np.einsum("bm,bmi,bmi->b", weights, centered_sources, centered_sources)
+        scales = (S[:, 0] + S[:, 1] + d * S[:, 2]) / source_variances
+
+    ts = target_centroids - scales[:, np.newaxis] * np.einsum("bij,bj->bi", Rs, source_centroids)
+    return Rs, ts, scales
+
+
 def drawlines(img1, lines):
     r, c, _ = img1.shape
     for r in lines:
@@ -391,8 +596,8 @@ def camera_pose_to_internal(serialized_camera_poses):
     return serialized_camera_poses
 
 
-# Opportunity for performance improvements here. This doesn't change
-# for a given capture but is recalculated fairly deep down the run loop
+# Doesn't change for a given capture, the live triangulation path gets these
+# precomputed from a Calibration instead
 def camera_poses_to_projection_matrices(camera_poses):
     Ps = []
     for i, camera_pose in enumerate(camera_poses):
@@ -401,14 +606,73 @@ def camera_poses_to_projection_matrices(camera_poses):
         Ps.append(P)
     return Ps
 
+# Finds every blob brighter than threshold in a single pass. Returns their
+# intensity weighted subpixel centroids as a float32 (N, 2) array along with
+# each blob's area in pixels and mean brightness
+def find_blobs(grey, threshold):
+    binary = cv.threshold(grey, threshold, 255, cv.THRESH_BINARY)[1]
+    num_labels, labels, stats, _ = cv.connectedComponentsWithStats(
+        binary, connectivity=8, ltype=cv.CV_16U
+    )
+    if num_labels <= 1:
+        return np.empty((0, 2), dtype=np.float32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+
+    # Only visit the (few) labelled pixels rather than the whole frame
+    pixel_indicies = np.flatnonzero(binary)
+    pixel_labels = labels.ravel()[pixel_indicies]
+    pixel_weights = grey.ravel()[pixel_indicies].astype(np.float64)
+    pixel_y, pixel_x = np.divmod(pixel_indicies, grey.shape[1])
+
+    weight_sums = np.bincount(pixel_labels, weights=pixel_weights, minlength=num_labels)[1:]
+    centroids = np.empty((num_labels - 1, 2), dtype=np.float32)
+    centroids[:, 0] = np.bincount(pixel_labels, weights=pixel_weights * pixel_x, minlength=num_labels)[1:] / weight_sums
+    centroids[:, 1] = np.bincount(pixel_labels, weights=pixel_weights * pixel_y, minlength=num_labels)[1:] / weight_sums
+
+    areas = stats[1:, cv.CC_STAT_AREA]
+    brightness = (weight_sums / areas).astype(np.float32)
+
+    return centroids, areas, brightness
+
+# Merges overlapping (x0, y0, x1, y1) windows so no pixel is scanned twice
+def merge_windows(windows):
+    windows = [list(window) for window in windows]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(0, len(windows)):
+            for j in range(i + 1, len(windows)):
+                a, b = windows[i], windows[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    windows[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del windows[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [tuple(window) for window in windows]
+
+# Maps centroids found on a raw frame to where they would have been found on
+# the squared, undistorted frame produced by full-frame image processing
+def undistort_image_points(image_points, frame_shape, intrinsic_matrix, distortion_coefs):
+    points = np.array(image_points, dtype=np.float32).reshape((-1, 1, 2))
+    points += np.array(square_offset(frame_shape), dtype=np.float32)
+    undistorted_points = cv.undistortPoints(
+        points, intrinsic_matrix, distortion_coefs, P=intrinsic_matrix
+    )
+    return undistorted_points[:, 0, :]
+
 def cartesian_product(x, y):
     return np.array([[x0, y0] for x0 in x for y0 in y])
 
+def square_offset(shape):
+    size = max(shape[0], shape[1])
+    return (size - shape[1]) // 2, (size - shape[0]) // 2
+
 def make_square(img):
     x, y, _ = img.shape
     size = max(x, y)
     new_img = np.zeros((size, size, 3), dtype=np.uint8)
-    ax, ay = (size - img.shape[1]) // 2, (size - img.shape[0]) // 2
+    ax, ay = square_offset(img.shape)
     new_img[ay : img.shape[0] + ay, ax : ax + img.shape[1]] = img
 
     # Pad the new_img array with edge pixel values
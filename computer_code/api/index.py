@@ -1,5 +1,6 @@
 from sklearn.linear_model import RANSACRegressor
 import time
+import argparse
 import cv2 as cv
 import numpy as np
 from scipy import linalg
@@ -9,11 +10,14 @@ from flask_socketio import SocketIO
 from flask_cors import CORS
 
 from settings import intrinsic_matrices
-from cameras import Cameras
+from cameras import Cameras, ProcessingModes, OverlayModes
+from SocketChannels import WireFormats
+from ReplayCamera import ReplayCamera
+from SimulatedCamera import SimulatedCamera
+from CalibrationWorker import CalibrationWorker, CalibrationCancelled
 from helpers import (
     camera_poses_to_serializable,
     calculate_reprojection_errors,
-    bundle_adjustment,
     triangulate_points,
     camera_pose_to_internal
 )
@@ -21,6 +25,7 @@ from helpers import (
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
 socketio = SocketIO(app, cors_allowed_origins="*")
+calibration_worker = CalibrationWorker()
 
 @app.route("/api/camera-stream")
 def camera_stream():
@@ -31,33 +36,40 @@ def camera_stream():
         camera = int(camera)
     cameras = Cameras.instance()
     cameras.set_socketio(socketio)
+    # Opening a stream restarts capture if it stopped, e.g. after too many
+    # failed frames
+    cameras.start_capture()
 
     def gen(cameras, camera):
-        last_frame_time = 0
-        frame_size = 20
-        i = 0
-
-        while True:
-            time_now = time.time()
-
-            i = (i + 1) % frame_size
-            if i == 0:
-                fps_frame_average = (time_now - last_frame_time)/frame_size
-                socketio.emit("fps", {"fps": round(1 / fps_frame_average)})
-                last_frame_time = time.time()
-
-            frames = cameras.get_frames(camera)
-            jpeg_frame = cv.imencode(".jpg", frames)[1].tobytes()
-
-            yield (
-                b"--frame\r\n"
-                b"Content-Type: image/jpeg\r\n\r\n" + jpeg_frame + b"\r\n"
-            )
+        # Frames come from the shared capture loop, opening another stream only
+        # adds a subscriber rather than another pass through the pipeline. The
+        # stream ends once capture stops
+        subscription = cameras.subscribe()
+        try:
+            while True:
+                jpeg_frame = cameras.get_jpeg(subscription, camera)
+                if jpeg_frame is None:
+                    if not cameras.is_capturing:
+                        break
+                    continue
+
+                yield (
+                    b"--frame\r\n"
+                    b"Content-Type: image/jpeg\r\n\r\n" + jpeg_frame + b"\r\n"
+                )
+        finally:
+            subscription.close()
 
     return Response(
         gen(cameras, camera), mimetype="multipart/x-mixed-replace; boundary=frame"
     )
 
+@app.route("/api/metrics")
+def metrics():
+    cameras = Cameras.instance()
+
+    return Response(cameras.metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/api/camera_state")
 def camera_state():
     cameras = Cameras.instance()
@@ -211,100 +223,74 @@ def change_camera_settings(data):
 
 @socketio.on("calculate-bundle-adjustment")
 def calculate_bundle_adjustment(data):
-    cameras = Cameras.instance()
     image_points = np.array(data["cameraPoints"])
     camera_poses = camera_pose_to_internal(data["cameraPoses"])
-    camera_poses = bundle_adjustment(image_points, camera_poses)
-
-    object_points = triangulate_points(image_points, camera_poses)
-    error = np.mean(
-        calculate_reprojection_errors(image_points, object_points, camera_poses)
-    )
-    print(f"New pose computed, average reprojection error: {error}")
-    cameras.set_camera_poses(camera_poses)
-
-    socketio.emit(
-        "camera-pose", {"camera_poses": camera_poses_to_serializable(camera_poses)}
-    )
-    socketio.emit("success", f"Camera pose updated {error}")
+    start_calibration(image_points, camera_poses)
 
 @socketio.on("calculate-camera-pose")
 def calculate_camera_pose(data):
-    cameras = Cameras.instance()
     image_points = np.array(data["cameraPoints"])
+    start_calibration(image_points)
 
-    image_points_t = image_points.transpose((1, 0, 2))
-
-    camera_poses = [{"R": np.eye(3), "t": np.array([[0], [0], [0]], dtype=np.float32)}]
-    for camera_i in range(0, cameras.num_cameras - 1):
-        camera1_image_points = image_points_t[camera_i]
-        camera2_image_points = image_points_t[camera_i + 1]
-        not_none_indicies = np.where(
-            np.all(camera1_image_points != None, axis=1)
-            & np.all(camera2_image_points != None, axis=1)
-        )[0]
-        camera1_image_points = np.take(
-            camera1_image_points, not_none_indicies, axis=0
-        ).astype(np.float32)
-        camera2_image_points = np.take(
-            camera2_image_points, not_none_indicies, axis=0
-        ).astype(np.float32)
-
-        F, _ = cv.findFundamentalMat(
-            camera1_image_points, camera2_image_points, cv.FM_RANSAC, 3, 0.99999
-        )
-        if F is None:
-            socketio.emit("error", "Could not compute fundamental matrix")
-            return
-        E = cv.sfm.essentialFromFundamental(
-            F,
-            intrinsic_matrices[camera_i],
-            intrinsic_matrices[camera_i+1]
-        )
-        possible_Rs, possible_ts = cv.sfm.motionFromEssential(E)
-
-        R = None
-        t = None
-        max_points_infront_of_camera = 0
-        for i in range(0, 4):
-            object_points = triangulate_points(
-                np.hstack(
-                    [
-                        np.expand_dims(camera1_image_points, axis=1),
-                        np.expand_dims(camera2_image_points, axis=1),
-                    ]
-                ),
-                np.concatenate(
-                    [[camera_poses[-1]], [{"R": possible_Rs[i], "t": possible_ts[i]}]]
-                ),
-            )
-            object_points_camera_coordinate_frame = np.array(
-                [possible_Rs[i].T @ object_point for object_point in object_points]
-            )
+@socketio.on("cancel-calibration")
+def cancel_calibration(data):
+    calibration_worker.cancel()
 
-            points_infront_of_camera = np.sum(object_points[:, 2] > 0) + np.sum(
-                object_points_camera_coordinate_frame[:, 2] > 0
-            )
-
-            if points_infront_of_camera > max_points_infront_of_camera:
-                max_points_infront_of_camera = points_infront_of_camera
-                R = possible_Rs[i]
-                t = possible_ts[i]
+def start_calibration(image_points, camera_poses=None):
+    if not calibration_worker.start(image_points, camera_poses):
+        socketio.emit("error", "A calibration is already running")
+        return
+    socketio.emit("calibration-progress", {"running": True})
+    socketio.start_background_task(watch_calibration, image_points)
 
-        R = R @ camera_poses[-1]["R"]
-        t = camera_poses[-1]["t"] + (camera_poses[-1]["R"] @ t)
+def watch_calibration(image_points):
+    while calibration_worker.is_running():
+        for update in calibration_worker.poll():
+            socketio.emit("calibration-progress", {"running": True, **update})
+        socketio.sleep(0.1)
+    for update in calibration_worker.poll():
+        socketio.emit("calibration-progress", {"running": True, **update})
 
-        camera_poses.append({"R": R, "t": t})
+    try:
+        camera_poses, camera_errors = calibration_worker.result()
+    except CalibrationCancelled:
+        socketio.emit("calibration-progress", {"running": False})
+        socketio.emit("success", "Calibration cancelled")
+        return
+    except Exception as e:
+        socketio.emit("calibration-progress", {"running": False})
+        socketio.emit("error", f"Calibration failed: {e}")
+        return
 
-    camera_poses = bundle_adjustment(image_points, camera_poses)
+    unobserved_cameras = []
+    for camera_error in camera_errors:
+        if camera_error["mean_error"] is None:
+            unobserved_cameras.append(camera_error["camera"])
+            print(f"Camera {camera_error['camera']}: no observations")
+            continue
+        print(
+            f"Camera {camera_error['camera']}: {camera_error['observations']} observations, "
+            f"mean error {camera_error['mean_error']:.3f}px, max error {camera_error['max_error']:.3f}px"
+        )
+    if len(unobserved_cameras) != 0:
+        # Their poses are only the initial estimate, don't use them
+        socketio.emit("calibration-progress", {"running": False})
+        socketio.emit("error", f"Calibration failed: no observations from cameras {unobserved_cameras}")
+        return
 
-    object_points = triangulate_points(image_points, camera_poses)
-    error = np.mean(
-        calculate_reprojection_errors(image_points, object_points, camera_poses)
-    )
-    print(f"New pose computed, average reprojection error: {error}")
-    cameras.set_camera_poses(camera_poses)
+    try:
+        object_points = triangulate_points(image_points, camera_poses)
+        error = np.mean(
+            calculate_reprojection_errors(image_points, object_points, camera_poses)
+        )
+        print(f"New pose computed, average reprojection error: {error}")
+        Cameras.instance().set_camera_poses(camera_poses)
+    except Exception as e:
+        socketio.emit("calibration-progress", {"running": False})
+        socketio.emit("error", f"Calibration failed: {e}")
+        return
 
+    socketio.emit("calibration-progress", {"running": False})
     socketio.emit(
         "camera-pose", {"camera_poses": camera_poses_to_serializable(camera_poses)}
     )
@@ -320,6 +306,62 @@ def start_or_stop_image_processing(data):
     elif start_or_stop == "stop":
         cameras.stop_image_processing()
 
+@socketio.on("processing-mode")
+def set_processing_mode(data):
+    cameras = Cameras.instance()
+    mode = data["mode"]
+
+    if mode == "full-frame":
+        cameras.set_processing_mode(ProcessingModes.FullFrame)
+    elif mode == "points-only":
+        cameras.set_processing_mode(ProcessingModes.PointsOnly)
+
+@socketio.on("overlay-mode")
+def set_overlay_mode(data):
+    cameras = Cameras.instance()
+    mode = data["mode"]
+
+    if mode == "auto":
+        cameras.set_overlay_mode(OverlayModes.Auto)
+    elif mode == "always":
+        cameras.set_overlay_mode(OverlayModes.Always)
+    elif mode == "never":
+        cameras.set_overlay_mode(OverlayModes.Never)
+
+@socketio.on("connect")
+def connect():
+    cameras = Cameras.instance()
+    if cameras.socket_channels is not None:
+        cameras.socket_channels.add_client(request.sid)
+
+@socketio.on("disconnect")
+def disconnect():
+    cameras = Cameras.instance()
+    if cameras.socket_channels is not None:
+        cameras.socket_channels.remove_client(request.sid)
+
+@socketio.on("subscribe")
+def subscribe(data):
+    cameras = Cameras.instance()
+    if cameras.socket_channels is None:
+        return
+    try:
+        cameras.socket_channels.subscribe(request.sid, data["channels"])
+    except (KeyError, TypeError, ValueError) as e:
+        socketio.emit("error", f"Invalid subscription: {e}", to=request.sid)
+
+@socketio.on("wire-format")
+def set_wire_format(data):
+    cameras = Cameras.instance()
+    if cameras.socket_channels is None:
+        return
+    wire_format = data["format"]
+
+    if wire_format == "json":
+        cameras.socket_channels.set_wire_format(request.sid, WireFormats.Json)
+    elif wire_format == "binary":
+        cameras.socket_channels.set_wire_format(request.sid, WireFormats.Binary)
+
 @socketio.on("capture-points")
 def capture_points(data):
     start_or_stop = data["startOrStop"]
@@ -355,6 +397,84 @@ def start_or_stop_locating_objects(data):
     elif start_or_stop == "stop":
         cameras.stop_locating_objects()
 
+@socketio.on("record")
+def start_or_stop_recording(data):
+    cameras = Cameras.instance()
+    start_or_stop = data["startOrStop"]
+
+    if start_or_stop == "start":
+        path = data.get("path") or f"./recordings/{time.strftime('%Y%m%d-%H%M%S')}"
+        try:
+            cameras.start_recording(path)
+        except RuntimeError as e:
+            socketio.emit("error", str(e))
+            return
+        socketio.emit("success", f"Recording to {path}")
+    elif start_or_stop == "stop":
+        frame_recorder = cameras.stop_recording()
+        if frame_recorder is None:
+            return
+        message = (
+            f"Recorded {frame_recorder.num_frames} frames to {frame_recorder.path}, "
+            f"{frame_recorder.dropped_frames} dropped"
+        )
+        if frame_recorder.error is not None:
+            socketio.emit("error", f"{message}, recording failed: {frame_recorder.error}")
+        else:
+            socketio.emit("success", message)
+
+@socketio.on("session-log")
+def start_or_stop_session_log(data):
+    cameras = Cameras.instance()
+    start_or_stop = data["startOrStop"]
+
+    if start_or_stop == "start":
+        path = data.get("path") or f"./sessions/{time.strftime('%Y%m%d-%H%M%S')}"
+        try:
+            cameras.start_session_log(path)
+        except RuntimeError as e:
+            socketio.emit("error", str(e))
+            return
+        socketio.emit("success", f"Logging session to {path}")
+    elif start_or_stop == "stop":
+        session_logger = cameras.stop_session_log()
+        if session_logger is None:
+            return
+        message = (
+            f"Logged {session_logger.num_frames} frames to {session_logger.path}, "
+            f"{session_logger.dropped_frames} dropped"
+        )
+        if session_logger.error is not None:
+            socketio.emit("error", f"{message}, logging failed: {session_logger.error}")
+        elif session_logger.failed_frames != 0:
+            socketio.emit(
+                "error",
+                f"{message}, {session_logger.failed_frames} failed: {session_logger.last_frame_error}",
+            )
+        else:
+            socketio.emit("success", message)
+
+@socketio.on("rigid-bodies")
+def set_rigid_bodies(data):
+    cameras = Cameras.instance()
+    try:
+        cameras.set_rigid_bodies(data["rigidBodies"])
+    except (KeyError, TypeError, ValueError) as e:
+        socketio.emit("error", f"Invalid rigid bodies: {e}")
+        return
+    socketio.emit("rigid-bodies", {"rigid_bodies": cameras.rigid_bodies.to_serializable()})
+
+@socketio.on("roi-tracking")
+def start_or_stop_roi_tracking(data):
+    cameras = Cameras.instance()
+    start_or_stop = data["startOrStop"]
+
+    if start_or_stop == "start":
+        cameras.start_roi_tracking()
+        return
+    elif start_or_stop == "stop":
+        cameras.stop_roi_tracking()
+
 
 @socketio.on("capture_image")
 def capture_image():
@@ -388,12 +508,28 @@ def determine_scale(data):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replay", help="Replay a recording instead of using the cameras")
+    parser.add_argument("--replay-speed", type=float, default=1.0, help="Replay speed, 0 for as fast as possible")
+    parser.add_argument("--simulate", type=int, metavar="CAMERAS", help="Use this many simulated cameras instead of the cameras")
+    parser.add_argument("--simulated-markers", type=int, default=2, help="Markers in the simulated scene")
+    args = parser.parse_args()
+
     cameras = Cameras.instance()
+    if args.replay is not None:
+        cameras.set_camera_source(ReplayCamera(args.replay, speed=args.replay_speed or None))
+    elif args.simulate is not None:
+        cameras.set_camera_source(
+            SimulatedCamera(num_cameras=args.simulate, num_markers=args.simulated_markers)
+        )
+    cameras.set_socketio(socketio)
+    cameras.start_capture()
     try:
         socketio.run(app, port=3001, debug=True, use_reloader=False)
         socketio.emit("started")
     finally:
         print("\nReleasing cameras")
+        calibration_worker.shutdown()
         cameras.end()
         socketio.emit("stopped")
         print("\nGoodbye")
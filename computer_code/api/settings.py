@@ -30,4 +30,15 @@ intrinsic_cam4 = np.array([
 ])
 dist_cam4 = np.array([[-0.1097657 ,  0.04591435, -0.00058153,  0.00035238,  0.14757552]])
 intrinsic_matrices = [intrinsic_cam1, intrinsic_cam2, intrinsic_cam3, intrinsic_cam4]
-distortion_coefs = [dist_cam1, dist_cam2, dist_cam3, dist_cam4]
\ No newline at end of file
+distortion_coefs = [dist_cam1, dist_cam2, dist_cam3, dist_cam4]
+# Marker positions of each tracked rigid body in its own frame, in meters.
+# Markers only need to be correct relative to each other, the registry
+# recentres them on their centroid. Tolerance is the allowed error, in meters,
+# of each distance between two markers
+rigid_bodies = [
+    {
+        "name": "drone",
+        "markers": [[-0.0655, 0, 0], [0.0655, 0, 0]],
+        "tolerance": 0.025,
+    },
+]
@@ -0,0 +1,56 @@
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from RigidBodies import RigidBodyRegistry
+from helpers import locate_objects
+
+MARKERS = [[0, 0, 0], [0.1, 0, 0], [0, 0.17, 0]]
+
+
+def place(markers, rotvec, position):
+    return Rotation.from_rotvec(rotvec).apply(markers) + position
+
+
+def test_identical_bodies_are_all_matched():
+    registry = RigidBodyRegistry([{"name": "drone", "markers": MARKERS, "tolerance": 0.01}])
+    object_points = np.concatenate(
+        [
+            place(MARKERS, [0, 0, 0.3], [0, 0, 1]),
+            place(MARKERS, [0.2, 0, -1.0], [1, 0.5, 1]),
+        ]
+    )
+
+    matches = registry.match(object_points)
+
+    assert [body_index for body_index, _, _ in matches] == [0, 0]
+    assert sorted(np.concatenate([point_indicies for _, point_indicies, _ in matches])) == list(range(6))
+
+
+def test_locate_objects_finds_every_copy():
+    registry = RigidBodyRegistry([{"name": "drone", "markers": MARKERS, "tolerance": 0.01}])
+    positions = np.array([[0, 0, 1], [1, 0.5, 1]])
+    object_points = np.concatenate(
+        [place(MARKERS, [0, 0, 0.3], positions[0]), place(MARKERS, [0, 0, -1.0], positions[1])]
+    )
+    centroid = np.mean(MARKERS, axis=0)
+
+    objects = locate_objects(object_points, np.zeros(len(object_points)), registry)
+
+    assert len(objects) == 2
+    found = sorted(object["pos"].tolist() for object in objects)
+    expected = sorted(
+        (place([centroid], rotvec, position)[0]).tolist()
+        for rotvec, position in [([0, 0, 0.3], positions[0]), ([0, 0, -1.0], positions[1])]
+    )
+    np.testing.assert_allclose(found, expected, atol=1e-9)
+
+
+def test_collinear_markers_have_no_orientation():
+    registry = RigidBodyRegistry([{"name": "bar", "markers": [[-0.0655, 0, 0], [0.0655, 0, 0]], "tolerance": 0.01}])
+    object_points = place([[-0.0655, 0, 0], [0.0655, 0, 0]], [0, 0, 0.3], [0, 0, 1])
+
+    objects = locate_objects(object_points, np.zeros(len(object_points)), registry)
+
+    assert len(objects) == 1
+    assert objects[0]["rotation"] is None and objects[0]["quaternion"] is None
+    np.testing.assert_allclose(objects[0]["pos"], [0, 0, 1], atol=1e-9)
@@ -1,7 +1,7 @@
 from helpers import (
     camera_poses_to_serializable,
     calculate_reprojection_errors,
-    bundle_adjustment,
+    sparse_bundle_adjustment,
     triangulate_points,
 )
 
@@ -90,7 +90,8 @@ for camera_i in range(0, num_cameras - 1):
 
     camera_poses.append({"R": R, "t": t})
 
-camera_poses = bundle_adjustment(image_points, camera_poses)
+camera_poses, _, camera_errors, solve = sparse_bundle_adjustment(image_points, camera_poses)
+print(solve)
 
 object_points = triangulate_points(image_points, camera_poses)
 error = np.mean(
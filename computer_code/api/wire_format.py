@@ -0,0 +1,161 @@
+import struct
+import numpy as np
+
+# Binary layout of an object-points message, all little-endian. Mirrored by
+# the decoder in src/shared/styles/scripts/socket.ts, bump VERSION on change.
+#
+# header    magic "MCAP", uint16 version, uint16 flags, float64 time_ms,
+#           uint32 counts: cameras, object points, objects, filtered objects
+# uint32    image point count of each camera
+# float32   image points (x, y) of each camera in turn
+# float32   object points (x, y, z)
+# float32   errors, one per object point
+# float32   objects (pos xyz, quaternion xyzw, heading, error, droneIndex)
+# float32   filtered objects (pos xyz, vel xyz, quaternion xyzw, heading,
+#           droneIndex)
+#
+# Every section is a multiple of 4 bytes so the decoder can view each one as
+# a Float32Array. Missing values (e.g. no quaternion) are NaN.
+#
+# flags has a bit for each section the message carries (see Sections), an
+# absent section has a count of 0 and decodes to a missing key, not an empty
+# list. Object points and their errors are one section.
+MAGIC = b"MCAP"
+VERSION = 2
+HEADER = struct.Struct("<4sHHdIIII")
+OBJECT_FIELDS = 10
+FILTERED_OBJECT_FIELDS = 12
+
+
+class Sections():
+    ImagePoints = 1
+    ObjectPoints = 2
+    Objects = 4
+    FilteredObjects = 8
+
+
+# Sections given as None are left out of the message
+def encode_object_points(time_ms, image_points=None, object_points=None, errors=None, objects=None, filtered_objects=None):
+    flags = 0
+    if image_points is not None:
+        flags |= Sections.ImagePoints
+    if object_points is not None:
+        flags |= Sections.ObjectPoints
+    if objects is not None:
+        flags |= Sections.Objects
+    if filtered_objects is not None:
+        flags |= Sections.FilteredObjects
+
+    camera_points = [_camera_image_points(points) for points in image_points or []]
+    object_points = np.asarray(object_points if object_points is not None else [], dtype=np.float32).reshape((-1, 3))
+    errors = np.asarray(errors if errors is not None else [], dtype=np.float32).reshape(-1)
+    objects = objects or []
+    filtered_objects = filtered_objects or []
+
+    object_rows = np.full((len(objects), OBJECT_FIELDS), np.nan, dtype=np.float32)
+    for i, object in enumerate(objects):
+        object_rows[i, 0:3] = object["pos"]
+        if object.get("quaternion") is not None:
+            object_rows[i, 3:7] = object["quaternion"]
+        object_rows[i, 7] = object["heading"]
+        object_rows[i, 8] = object["error"]
+        object_rows[i, 9] = object["droneIndex"]
+
+    filtered_rows = np.full((len(filtered_objects), FILTERED_OBJECT_FIELDS), np.nan, dtype=np.float32)
+    for i, filtered_object in enumerate(filtered_objects):
+        filtered_rows[i, 0:3] = filtered_object["pos"]
+        filtered_rows[i, 3:6] = filtered_object["vel"]
+        if filtered_object.get("quaternion") is not None:
+            filtered_rows[i, 6:10] = filtered_object["quaternion"]
+        filtered_rows[i, 10] = filtered_object["heading"]
+        filtered_rows[i, 11] = filtered_object["droneIndex"]
+
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        flags,
+        float(time_ms),
+        len(camera_points),
+        len(object_points),
+        len(objects),
+        len(filtered_objects),
+    )
+    counts = np.array([len(points) for points in camera_points], dtype="<u4")
+
+    return b"".join(
+        [header, counts.tobytes()]
+        + [points.astype("<f4").tobytes() for points in camera_points]
+        + [
+            object_points.astype("<f4").tobytes(),
+            errors.astype("<f4").tobytes(),
+            object_rows.astype("<f4").tobytes(),
+            filtered_rows.astype("<f4").tobytes(),
+        ]
+    )
+
+
+def decode_object_points(data):
+    """
+    Inverse of `encode_object_points`, returns the same dict the JSON
+    object-points message carries, with only the keys of the sections it
+    has. Cameras with no points decode as `[[None, None]]`, as they are sent
+    in JSON.
+
+    """
+    magic, version, flags, time_ms, num_cameras, num_object_points, num_objects, num_filtered_objects = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not an object-points message version {VERSION}")
+
+    offset = HEADER.size
+    counts = np.frombuffer(data, dtype="<u4", count=num_cameras, offset=offset)
+    offset += 4 * num_cameras
+
+    def read(count, shape):
+        nonlocal offset
+        values = np.frombuffer(data, dtype="<f4", count=count, offset=offset).reshape(shape)
+        offset += 4 * count
+        return values.astype(np.float64)
+
+    image_points = []
+    for count in counts:
+        points = read(int(count) * 2, (-1, 2))
+        image_points.append(points.tolist() if len(points) else [[None, None]])
+    object_points = read(num_object_points * 3, (-1, 3))
+    errors = read(num_object_points, (-1,))
+    object_rows = read(num_objects * OBJECT_FIELDS, (-1, OBJECT_FIELDS))
+    filtered_rows = read(num_filtered_objects * FILTERED_OBJECT_FIELDS, (-1, FILTERED_OBJECT_FIELDS))
+
+    message = {"time_ms": time_ms}
+    if flags & Sections.ImagePoints:
+        message["image_points"] = image_points
+    if flags & Sections.ObjectPoints:
+        message["object_points"] = object_points.tolist()
+        message["errors"] = errors.tolist()
+    if flags & Sections.Objects:
+        message["objects"] = [
+            {
+                "pos": row[0:3].tolist(),
+                "quaternion": None if np.isnan(row[3]) else row[3:7].tolist(),
+                "heading": float(row[7]),
+                "error": float(row[8]),
+                "droneIndex": int(row[9]),
+            }
+            for row in object_rows
+        ]
+    if flags & Sections.FilteredObjects:
+        message["filtered_objects"] = [
+            {
+                "pos": row[0:3].tolist(),
+                "vel": row[3:6].tolist(),
+                "quaternion": None if np.isnan(row[6]) else row[6:10].tolist(),
+                "heading": float(row[10]),
+                "droneIndex": int(row[11]),
+            }
+            for row in filtered_rows
+        ]
+    return message
+
+
+def _camera_image_points(points):
+    points = np.array(points, dtype=np.float32).reshape((-1, 2))
+    return points[~np.any(np.isnan(points), axis=1)]
@@ -8,7 +8,7 @@ import CameraWireframe from './components/CameraWireframe';
 import { Canvas } from '@react-three/fiber'
 import { OrbitControls } from '@react-three/drei'
 import Points from './components/Points';
-import { socket } from './shared/styles/scripts/socket';
+import { socket, onObjectPoints } from './shared/styles/scripts/socket';
 import Objects from './components/Objects';
 import { defaultCameraPose, defaultWorldMatrix } from './defaultCameraPose';
 import PosePoints from './components/PosePoints';
@@ -33,8 +33,10 @@ export default function App() {
   const objectPoints = useRef<Array<Array<Array<number>>>>([])
   const objectPointTimes = useRef<Array<Array<Array<number>>>>([])
   const filteredObjects = useRef<object[][]>([])
+  const filteredObjectTimes = useRef<Array<number>>([])
   const objectPointErrors = useRef<Array<Array<number>>>([])
   const imagePoints = useRef<Array<Array<number>>>([])
+  const imagePointTimes = useRef<Array<number>>([])
   const objects = useRef<Array<Array<Object>>>([])
   const [objectPointCount, setObjectPointCount] = useState(0);
 
@@ -95,20 +97,29 @@ export default function App() {
   }, [objectPointCount])
 
   useEffect(() => {
-    socket.on("object-points", (data) => {
-      objectPoints.current.push(data["object_points"])
-      objectPointTimes.current.push(data["time_ms"])
-      if (data["filtered_objects"].length != 0) {
+    const removeObjectPointsListener = onObjectPoints((data) => {
+      // Channels that weren't due this frame are missing from the message
+      if ("object_points" in data) {
+        objectPoints.current.push(data["object_points"])
+        objectPointTimes.current.push(data["time_ms"])
+        objectPointErrors.current.push(data["errors"])
+      }
+      if ("filtered_objects" in data && data["filtered_objects"].length != 0) {
         filteredObjects.current.push(data["filtered_objects"])
+        filteredObjectTimes.current.push(data["time_ms"])
+      }
+      if ("image_points" in data) {
+        imagePoints.current.push(data["image_points"])
+        imagePointTimes.current.push(data["time_ms"])
+      }
+      if ("objects" in data) {
+        objects.current.push(data["objects"])
       }
-      objectPointErrors.current.push(data["errors"])
-      imagePoints.current.push(data["image_points"])
-      objects.current.push(data["objects"])
       setObjectPointCount(objectPointCount + 1)
     })
 
     return () => {
-      socket.off("object-points")
+      removeObjectPointsListener()
     }
   }, [objectPointCount])
 
@@ -241,9 +252,11 @@ export default function App() {
                         objectPoints.current = []
                         objectPointTimes.current = [];
                         imagePoints.current = []
+                        imagePointTimes.current = []
                         objectPointErrors.current = []
                         objects.current = []
                         filteredObjects.current = []
+                        filteredObjectTimes.current = []
                       }
                       setIsTriangulatingPoints(!isTriangulatingPoints);
                       startLiveMocap(isTriangulatingPoints ? "stop" : "start");
@@ -299,8 +312,8 @@ export default function App() {
                   <div className="mt-2">
                   <DownloadControls type="csv" label="object points" objectPoints={objectPoints} objectPointTimes={objectPointTimes} />
                   <DownloadControls type="csv" label="object errors" objectPoints={objectPointErrors} objectPointTimes={objectPointTimes} />
-                  <DownloadControls type="jsonl" label="image points" objectPoints={imagePoints} objectPointTimes={objectPointTimes} />
-                  <DownloadControls type="jsonl" label="object track points" objectPoints={filteredObjects} objectPointTimes={objectPointTimes} />
+                  <DownloadControls type="jsonl" label="image points" objectPoints={imagePoints} objectPointTimes={imagePointTimes} />
+                  <DownloadControls type="jsonl" label="object track points" objectPoints={filteredObjects} objectPointTimes={filteredObjectTimes} />
                   </div>
                 </Col>
               </Row>
@@ -17,6 +17,7 @@ export default function CameraPoseCalibration({ cameraPoses, setParsedCapturedPo
     const [overlayVisible, setOverlayVisible] = useState(false);
     const [captureNextPointForPose, setCaptureNextPointForPose] = useState(false)
     const [capturedPointsForPose, setCapturedPointsForPose] = useState("");
+    const [calibrationProgress, setCalibrationProgress] = useState<any>({ running: false });
     useEffect(() => {
         const handler = (data: any) => {
             if (captureNextPointForPose) {
@@ -32,6 +33,16 @@ export default function CameraPoseCalibration({ cameraPoses, setParsedCapturedPo
             socket.off("image-points", handler)
         }
     }, [capturedPointsForPose, captureNextPointForPose])
+    useEffect(() => {
+        socket.on("calibration-progress", (data) => {
+            setCalibrationProgress(data)
+        })
+
+        return () => {
+            socket.off("calibration-progress")
+        }
+    }, [])
+
     const calculateCameraPose = async (cameraPoints: Array<Array<Array<number>>>) => {
         socket.emit("calculate-camera-pose", { cameraPoints })
     }
@@ -52,6 +63,11 @@ export default function CameraPoseCalibration({ cameraPoses, setParsedCapturedPo
         <Overlay target={target.current} show={overlayVisible} placement="top" rootClose={true} onHide={() => setOverlayVisible(false)}>
             <div className="overlay" style={{width: 600}}>
                 <div>{countOfPointsForCameraPoseCalibration} points collected</div>
+                {calibrationProgress.running &&
+                    <div>
+                        Solving{calibrationProgress.iteration !== undefined && `: iteration ${calibrationProgress.iteration}, cost ${calibrationProgress.cost.toFixed(1)}, error ${calibrationProgress.error.toFixed(3)}px`}
+                    </div>
+                }
                 <Button
                     size='sm'
                     variant="outline-primary"
@@ -66,7 +82,7 @@ export default function CameraPoseCalibration({ cameraPoses, setParsedCapturedPo
                     size='sm'
                     className=""
                     variant="outline-primary"
-                    disabled={countOfPointsForCameraPoseCalibration === 0}
+                    disabled={countOfPointsForCameraPoseCalibration === 0 || calibrationProgress.running}
                     onClick={() => {
                         calculateCameraPose(JSON.parse(`[${capturedPointsForPose.slice(0, -1)}]`))
                     }}>
@@ -76,12 +92,21 @@ export default function CameraPoseCalibration({ cameraPoses, setParsedCapturedPo
                     size='sm'
                     className=""
                     variant="outline-primary"
-                    disabled={countOfPointsForCameraPoseCalibration === 0}
+                    disabled={countOfPointsForCameraPoseCalibration === 0 || calibrationProgress.running}
                     onClick={() => {
                         calculateBundleAdjustment(JSON.parse(`[${capturedPointsForPose.slice(0, -1)}]`))
                     }}>
                     Bundle Adjustment
                 </Button>
+                <Button
+                    size='sm'
+                    variant="outline-danger"
+                    disabled={!calibrationProgress.running}
+                    onClick={() => {
+                        socket.emit("cancel-calibration", {})
+                    }}>
+                    Cancel
+                </Button>
                 <Button
                     size='sm'
                     variant="outline-danger"
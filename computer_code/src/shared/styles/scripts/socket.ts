@@ -1,3 +1,115 @@
 import { io } from 'socket.io-client';
 
-export const socket = io("http://localhost:3001");
\ No newline at end of file
+export const socket = io("http://localhost:3001");
+
+// Binary object-points messages, see computer_code/api/wire_format.py for the layout
+const MAGIC = "MCAP"
+const VERSION = 2
+const HEADER_SIZE = 32
+const OBJECT_FIELDS = 10
+const FILTERED_OBJECT_FIELDS = 12
+// Header flag of each section a message carries
+const IMAGE_POINTS = 1
+const OBJECT_POINTS = 2
+const OBJECTS = 4
+const FILTERED_OBJECTS = 8
+
+export type WireFormat = "json" | "binary"
+
+export const setWireFormat = (format: WireFormat) => {
+  socket.emit("wire-format", { format })
+}
+
+export type Channel = "image-points" | "object-points" | "objects" | "filtered-objects" | "fps"
+
+// Replaces this client's channels, each with a max rate in Hz or null for every frame
+export const subscribeChannels = (channels: Partial<Record<Channel, number | null>>) => {
+  socket.emit("subscribe", { channels })
+}
+
+const toNumber = (value: number) => Number.isNaN(value) ? null : value
+
+export const decodeObjectPoints = (data: ArrayBuffer | ArrayBufferView) => {
+  // Copy into a fresh buffer so every section is 4 byte aligned
+  const bytes = data instanceof ArrayBuffer ? new Uint8Array(data) : new Uint8Array(data.buffer, data.byteOffset, data.byteLength)
+  const buffer = bytes.slice().buffer
+  const view = new DataView(buffer)
+
+  const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4))
+  const version = view.getUint16(4, true)
+  const flags = view.getUint16(6, true)
+  if (magic !== MAGIC || version !== VERSION) {
+    throw new Error(`Not an object-points message version ${VERSION}`)
+  }
+  const timeMs = view.getFloat64(8, true)
+  const numCameras = view.getUint32(16, true)
+  const numObjectPoints = view.getUint32(20, true)
+  const numObjects = view.getUint32(24, true)
+  const numFilteredObjects = view.getUint32(28, true)
+
+  let offset = HEADER_SIZE
+  const counts = new Uint32Array(buffer, offset, numCameras)
+  offset += 4 * numCameras
+
+  const read = (count: number) => {
+    const values = new Float32Array(buffer, offset, count)
+    offset += 4 * count
+    return values
+  }
+  const rows = (values: Float32Array, width: number) => {
+    const result: Array<Array<number>> = []
+    for (let i = 0; i < values.length; i += width) {
+      result.push(Array.from(values.subarray(i, i + width)))
+    }
+    return result
+  }
+
+  const imagePoints = Array.from(counts).map(count =>
+    count === 0 ? [[null, null]] : rows(read(count * 2), 2)
+  )
+  const objectPoints = rows(read(numObjectPoints * 3), 3)
+  const errors = Array.from(read(numObjectPoints))
+  const objects = rows(read(numObjects * OBJECT_FIELDS), OBJECT_FIELDS).map(row => ({
+    pos: row.slice(0, 3),
+    quaternion: Number.isNaN(row[3]) ? null : row.slice(3, 7),
+    heading: row[7],
+    error: toNumber(row[8]),
+    droneIndex: row[9],
+  }))
+  const filteredObjects = rows(read(numFilteredObjects * FILTERED_OBJECT_FIELDS), FILTERED_OBJECT_FIELDS).map(row => ({
+    pos: row.slice(0, 3),
+    vel: row.slice(3, 6),
+    quaternion: Number.isNaN(row[6]) ? null : row.slice(6, 10),
+    heading: row[10],
+    droneIndex: row[11],
+  }))
+
+  // Channels that weren't due are left out, as in the JSON message
+  const message: Record<string, any> = { time_ms: timeMs }
+  if (flags & IMAGE_POINTS) {
+    message.image_points = imagePoints
+  }
+  if (flags & OBJECT_POINTS) {
+    message.object_points = objectPoints
+    message.errors = errors
+  }
+  if (flags & OBJECTS) {
+    message.objects = objects
+  }
+  if (flags & FILTERED_OBJECTS) {
+    message.filtered_objects = filteredObjects
+  }
+  return message
+}
+
+// Listens for object points in either wire format, returns a function removing the listeners
+export const onObjectPoints = (handler: (data: any) => void) => {
+  const binaryHandler = (data: ArrayBuffer) => handler(decodeObjectPoints(data))
+  socket.on("object-points", handler)
+  socket.on("object-points-binary", binaryHandler)
+
+  return () => {
+    socket.off("object-points", handler)
+    socket.off("object-points-binary", binaryHandler)
+  }
+}